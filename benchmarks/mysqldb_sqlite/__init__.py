@@ -0,0 +1,96 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+# A small MySQLdb stand-in over SQLite, only for benchmarks.
+#
+# It supports what sqlmail uses: connect(**db_info), cursors with cursorclass,
+# %s parameters, ping, commit, and the MySQL functions date_format() and format()
+# that report sql uses to format values.
+
+import datetime
+import re
+import sqlite3
+
+import cursors
+
+# path of the SQLite file used when db_info has no "db"
+default_database = ":memory:"
+
+
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class ProgrammingError(Error):
+    pass
+
+
+_mysql_date_format = {
+    "%Y": "%Y", "%y": "%y", "%m": "%m", "%c": "%m", "%d": "%d", "%e": "%d",
+    "%H": "%H", "%k": "%H", "%i": "%M", "%s": "%S", "%S": "%S", "%M": "%B", "%b": "%b", "%W": "%A", "%a": "%a"
+}
+
+
+def _parse_date(value):
+    if isinstance(value, (int, long)):
+        value = str(value)
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%Y%m%d"):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def _date_format(value, fmt):
+    date = _parse_date(value)
+    if date is None:
+        return None
+    return re.sub(r"%[a-zA-Z]", lambda m: date.strftime(_mysql_date_format.get(m.group(0), m.group(0))), fmt)
+
+
+def _format(value, decimals):
+    if value is None:
+        return None
+    return "{0:,.{1}f}".format(float(value), int(decimals))
+
+
+class Connection(object):
+    def __init__(self, **kwargs):
+        self.database = kwargs.get("db") or default_database
+        try:
+            self.sqlite = sqlite3.connect(self.database, check_same_thread=False)
+        except sqlite3.Error as e:
+            raise OperationalError(str(e))
+        self.sqlite.create_function("date_format", 2, _date_format)
+        self.sqlite.create_function("format", 2, _format)
+
+    def cursor(self, cursorclass=None):
+        return (cursorclass or cursors.Cursor)(self)
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def ping(self, *args):
+        if self.sqlite is None:
+            raise OperationalError("connection is closed")
+
+    def get_host_info(self):
+        return "sqlite %s" % (self.database,)
+
+    def close(self):
+        if self.sqlite is not None:
+            self.sqlite.close()
+            self.sqlite = None
+
+
+def connect(**kwargs):
+    return Connection(**kwargs)
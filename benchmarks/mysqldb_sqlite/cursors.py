@@ -0,0 +1,71 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import re
+import sqlite3
+
+import mysqldb_sqlite
+
+
+def _translate(sql):
+    """ MySQLdb %s and %(name)s parameters to SQLite ? and :name parameters """
+    def replace(m):
+        if m.group(0) == "%%":
+            return "%"
+        if m.group(1):
+            return ":%s" % (m.group(1),)
+        return "?"
+    return re.sub(r"%%|%\((\w+)\)s|%s", replace, sql)
+
+
+class Cursor(object):
+    """ rows as tuples """
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.sqlite.cursor()
+        self.description = None
+
+    def execute(self, sql, args=None):
+        try:
+            if args is None:
+                self.cursor.execute(sql)
+            else:
+                self.cursor.execute(_translate(sql), args)
+        except sqlite3.OperationalError as e:
+            raise mysqldb_sqlite.OperationalError(str(e))
+        except sqlite3.Error as e:
+            raise mysqldb_sqlite.ProgrammingError(str(e))
+        self.description = self.cursor.description
+        return self.cursor.rowcount
+
+    def executemany(self, sql, args):
+        self.cursor.executemany(_translate(sql), args)
+
+    def _rows(self, rows):
+        return tuple(rows)
+
+    def fetchall(self):
+        return self._rows(self.cursor.fetchall())
+
+    def fetchmany(self, size=1):
+        return self._rows(self.cursor.fetchmany(size))
+
+    def fetchone(self):
+        rows = self._rows(self.cursor.fetchmany(1))
+        return rows[0] if rows else None
+
+    def close(self):
+        self.cursor.close()
+
+
+class DictCursor(Cursor):
+    """ rows as dicts of column name -> value """
+    def _rows(self, rows):
+        names = [column[0] for column in self.description]
+        return tuple(dict(zip(names, r)) for r in rows)
+
+
+# SQLite cursors never hold the whole result on the client, same as MySQL server-side cursors
+SSCursor = Cursor
+SSDictCursor = DictCursor
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+# Offline benchmarks of sqlmail, no MySQL and no mail server needed.
+#
+# A SQLite database stands in for MySQL (mysqldb_sqlite) and a local SMTP sink receives the mails.
+# Each stage is timed for each table size, and the results are written as json, such as:
+#
+#   python benchmarks/run.py --rows 1000,10000,100000 --output result.json
+#   python benchmarks/run.py --compare last_release.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCHMARK_DIR)
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+import mysqldb_sqlite
+# sqlmail imports MySQLdb, use the SQLite stand-in instead
+sys.modules["MySQLdb"] = mysqldb_sqlite
+sys.modules["MySQLdb.cursors"] = mysqldb_sqlite.cursors
+
+from smtp_sink import SMTPSink
+from sqlmail import chart_backend
+from sqlmail import email_util
+from sqlmail.sqlchart import SQLLineChart
+from sqlmail.sqltable import SQLTable, MultiSQLTable
+
+VERSIONS = ["total", "7.3", "7.4", "7.5"]
+
+TABLE_SQL = """select date_format(stat_date, '%Y-%m-%d') `Date`, version `Version`,
+               format(day_startup, 0) `Day run`, format(week_startup, 0) `Week run`,
+               format(month_startup, 0) `Month run`
+               from kpi order by stat_date"""
+MULTI_SQL1 = """select date_format(stat_date, '%Y-%m-%d') `Date`, day_startup `Day run`
+                from kpi where version = 'total' order by stat_date desc"""
+MULTI_SQL2 = """select date_format(stat_date, '%Y-%m-%d') `Date`, week_startup `Week run`,
+                format(month_startup, 0) `Month run` from kpi where version = 'total'"""
+CHART_SQL = """select date_format(stat_date, '%Y-%m-%d') `Date`, version, day_startup `Day run`
+               from kpi order by stat_date"""
+
+
+class NullBackend(chart_backend.ChartBackend):
+    """ render nothing, to time building chart options only """
+    name = "null"
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        return ""
+
+
+def seed(path, rows):
+    """
+    create table kpi with rows rows, one row for each version and day
+    """
+    conn = mysqldb_sqlite.connect(db=path)
+    cursor = conn.cursor()
+    cursor.execute("create table kpi (stat_date text, version text, "
+                   "day_startup integer, week_startup integer, month_startup integer)")
+    start = datetime.date(2000, 1, 1)
+
+    def generate():
+        for i in xrange(rows):
+            day = i // len(VERSIONS)
+            value = 100000 + (i * 7919) % 50000
+            yield ((start + datetime.timedelta(days=day)).strftime("%Y-%m-%d"), VERSIONS[i % len(VERSIONS)],
+                   value, value * 5, value * 20)
+
+    cursor.executemany("insert into kpi values (%s, %s, %s, %s, %s)", generate())
+    cursor.execute("create index kpi_version on kpi (version)")
+    conn.commit()
+    conn.close()
+
+
+def timed(results, stage, rows, repeat, func):
+    """
+    run func repeat times and record the times
+
+    :return: the result of the last run
+    """
+    runs = list()
+    result = None
+    for i in range(repeat):
+        start = time.time()
+        result = func()
+        runs.append(time.time() - start)
+    results.append({"stage": stage, "rows": rows, "best": min(runs), "mean": sum(runs) / len(runs), "runs": runs})
+    sys.stderr.write("%-30s %8d rows  best %.4fs\n" % (stage, rows, min(runs)))
+    return result
+
+
+def run_size(results, rows, work_dir, sink, args):
+    db_info = {"db": os.path.join(work_dir, "kpi_%d.db" % (rows,))}
+    timed(results, "seed", rows, 1, lambda: seed(db_info["db"], rows))
+
+    # tables
+    table = timed(results, "sql_table.build", rows, args.repeat, lambda: SQLTable(TABLE_SQL, db_info))
+    timed(results, "sql_table.to_html", rows, args.repeat, lambda: table.to_html())
+    timed(results, "sql_table.to_html_limited", rows, args.repeat, lambda: table.to_html(max_rows=args.mail_rows))
+
+    def build_multi_table():
+        multi_table = MultiSQLTable([u"Date", u"Day run", u"Week run", u"Month run", u"Total run"])
+        multi_table.add_data_source(MULTI_SQL1, db_info)
+        multi_table.add_data_source(MULTI_SQL2, db_info)
+        multi_table.add_complex_col(u"Total run", lambda row: row[u"Day run"] + row[u"Week run"])
+        return multi_table
+    multi_table = timed(results, "multi_table.build", rows, args.repeat, build_multi_table)
+    timed(results, "multi_table.to_html", rows, args.repeat, lambda: multi_table.to_html())
+
+    # charts
+    def build_chart_options():
+        chart = SQLLineChart(CHART_SQL, db_info, title="Day run", data_start_col=2)
+        chart.set_backend(NullBackend())
+        chart.draw(in_memory=True)
+        return chart
+    chart = timed(results, "line_chart.options", rows, args.repeat, build_chart_options)
+
+    with open(os.path.join(os.path.dirname(BENCHMARK_DIR), "sqlmail", "demo_files", "fighting.jpg"), "rb") as fd:
+        image = fd.read()
+    if args.chart_backend != "none":
+        backend = chart_backend.get_backend(args.chart_backend)
+        image = timed(results, "line_chart.render.%s" % (args.chart_backend,), rows, args.repeat,
+                      lambda: backend.render(chart.options, chart.scale, chart.width, chart.image_format))
+
+    # mail
+    content = table.to_html(max_rows=args.mail_rows) + u'<img src="cid:chart">'
+
+    def prepare_mail():
+        mail = email_util.NiceReportMail("bench<bench@localhost>", ["to@localhost"], u"Benchmark %d" % (rows,),
+                                         content)
+        mail.add_image_bytes("chart", image)
+        mail._prepare()
+        return mail
+    mail = timed(results, "mail.prepare", rows, args.repeat, prepare_mail)
+
+    # Email.send_mail prepares the mail and connects for each mail, as reports usually send
+    timed(results, "mail.send", rows, args.repeat, lambda: mail.send_mail(sink.address))
+    with email_util.SMTPSession(sink.address) as session:
+        timed(results, "mail.send_session", rows, args.repeat, lambda: session.send(mail, prepare=False))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BENCHMARK_DIR,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_file, threshold):
+    """
+    :return: list of stages slower than the baseline by more than threshold
+    """
+    with open(baseline_file) as fd:
+        baseline = dict(((r["stage"], r["rows"]), r["best"]) for r in json.load(fd)["results"])
+    slower = list()
+    for r in results:
+        old = baseline.get((r["stage"], r["rows"]))
+        if old and r["best"] > old * (1 + threshold):
+            slower.append({"stage": r["stage"], "rows": r["rows"], "baseline": old, "best": r["best"]})
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline benchmarks of sqlmail")
+    parser.add_argument("--rows", default="1000,10000,100000",
+                        help="comma separated table sizes, up to 1000000")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each stage, the best one is reported")
+    parser.add_argument("--chart-backend", default="matplotlib",
+                        help="backend to time chart rendering: matplotlib, phantomjs or none")
+    parser.add_argument("--mail-rows", type=int, default=1000, help="max rows of the table put into the mail")
+    parser.add_argument("--output", help="json result file, default is stdout")
+    parser.add_argument("--compare", help="json result file of an earlier run, exit 1 if a stage got slower")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown for --compare, 0.2 is 20%%")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="sqlmail_benchmark_")
+    sink = SMTPSink().start()
+    results = list()
+    try:
+        for rows in [int(r) for r in args.rows.split(",")]:
+            run_size(results, rows, work_dir, sink, args)
+    finally:
+        sink.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "time": datetime.datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "config": {"rows": args.rows, "repeat": args.repeat, "chart_backend": args.chart_backend,
+                   "mail_rows": args.mail_rows},
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as fd:
+            json.dump(report, fd, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        slower = compare(results, args.compare, args.threshold)
+        for s in slower:
+            sys.stderr.write("slower: %(stage)s %(rows)d rows %(baseline).4fs -> %(best).4fs\n" % s)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
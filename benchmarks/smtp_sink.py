@@ -0,0 +1,39 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import asyncore
+import smtpd
+import threading
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """
+    a local mail server that accepts and drops every mail, for benchmarks
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.host, self.port = self.socket.getsockname()
+        self.received = 0
+        self.received_bytes = 0
+        self.thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+        self.received_bytes += len(data)
+
+    @property
+    def address(self):
+        """ mail_server for Email.send_mail """
+        return "%s:%d" % (self.host, self.port)
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={"timeout": 0.1, "map": self._map})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.close()
+        if self.thread is not None:
+            self.thread.join(1)
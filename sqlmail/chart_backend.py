@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import json
+import os
+import tempfile
+from StringIO import StringIO
+
+import chart_server
+import columnar
+import instrument
+
+
+class ChartBackendException(Exception):
+    """Exception when chart backend is unknown or unavailable """
+
+
+class ChartBackend(object):
+    """
+    Base class of chart renderers.
+
+    A backend turns the highcharts options built by SQLLineChart/SQLStackChart into an image.
+    """
+    name = None
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        """
+        :param options: highcharts options dict
+        :param scale: zoom factor
+        :param width: image width in pixels
+        :param image_format: jpg, png or svg
+        :return: image content
+        """
+        raise NotImplementedError()
+
+
+class PhantomJSBackend(ChartBackend):
+    """
+    Render by highcharts.js in the bundled phantomjs,
+    on the chart server pool if it is started, otherwise in a new phantomjs process
+    """
+    name = "phantomjs"
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        pool = chart_server.get_pool()
+        if pool is not None:
+            # render by a long-lived phantomjs server instead of starting a new one
+            return pool.render(options, scale=scale, width=width, image_format=image_format)
+
+        # unique temp files, so charts drawn in parallel never clash
+        infile_fd, infile_name = tempfile.mkstemp(suffix='.json')
+        outfile_fd, outfile_name = tempfile.mkstemp(suffix='.%s' % (image_format,))
+        os.close(outfile_fd)
+        try:
+            with os.fdopen(infile_fd, 'w') as infile:
+                infile.write(json.JSONEncoder().encode(options))
+
+            phantomjs, convert_js = chart_server.phantomjs_command()
+            command = "{phantomjs} {convert_js} \
+                        -infile {infile} -outfile {outfile} -scale {scale} -width {width}".format(phantomjs=phantomjs,
+                                                                                              convert_js=convert_js,
+                                                                                              infile=infile_name,
+                                                                                              outfile=outfile_name,
+                                                                                              scale=scale,
+                                                                                              width=width)
+            with instrument.span("chart.subprocess", command="phantomjs"):
+                os.system(command)
+
+            with open(outfile_name, 'rb') as outfile:
+                return outfile.read()
+        finally:
+            os.remove(infile_name)
+            os.remove(outfile_name)
+
+
+class MatplotlibBackend(ChartBackend):
+    """
+    Render in process by matplotlib, no phantomjs at all.
+
+    Supports what SQLLineChart and SQLStackChart put into options:
+    title, categories, series with name/data/color, line markers,
+    data labels and column stacking (normal or percent).
+    """
+    name = "matplotlib"
+
+    # highcharts default colors, so charts look alike with both backends
+    default_colors = ['#7cb5ec', '#434348', '#90ed7d', '#f7a35c', '#8085e9',
+                      '#f15c80', '#e4d354', '#2b908f', '#f45b5b', '#91e8e1']
+
+    def __init__(self, dpi=100):
+        """
+        :param dpi: dots per inch of the figure at the chart width,
+                    the image is always width pixels wide and keeps the chart aspect ratio
+        :return:
+        """
+        self.dpi = dpi
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        try:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+        except ImportError:
+            raise ChartBackendException("matplotlib is required by the matplotlib chart backend")
+
+        # phantomjs ignores scale when width is set, do the same:
+        # the chart is laid out at its own width, and zoomed to width pixels
+        chart_width = options.get("chart", {}).get("width") or width
+        height = options.get("chart", {}).get("height") or 400
+        dpi = self.dpi * float(width) / chart_width
+        figure = Figure(figsize=(float(chart_width) / self.dpi, float(height) / self.dpi), dpi=dpi)
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(111)
+
+        categories = options.get("xAxis", {}).get("categories") or list()
+        series = options.get("series", list())
+        plot_options = options.get("plotOptions", {})
+        data_labels = plot_options.get("series", {}).get("dataLabels", {}).get("enabled", False)
+
+        if options.get("chart", {}).get("type") == "column":
+            self._draw_columns(axes, categories, series, plot_options.get("column", {}))
+        else:
+            marker = plot_options.get("line", {}).get("marker", {}).get("enabled", True)
+            self._draw_lines(axes, categories, series, marker, data_labels)
+
+        title = options.get("title", {}).get("text")
+        if title:
+            axes.set_title(title)
+        self._set_categories(axes, categories)
+        axes.grid(axis='y', color='#e6e6e6')
+        axes.set_axisbelow(True)
+        for side in ('top', 'right'):
+            axes.spines[side].set_visible(False)
+        if series:
+            axes.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1), ncol=min(len(series), 5),
+                        frameon=False, fontsize='small')
+        figure.tight_layout()
+
+        output = StringIO()
+        figure.savefig(output, format="jpeg" if image_format == "jpg" else image_format, dpi=dpi)
+        return output.getvalue()
+
+    def _color(self, item, index):
+        return item.get("color") or self.default_colors[index % len(self.default_colors)]
+
+    @staticmethod
+    def _set_categories(axes, categories):
+        if not categories:
+            return
+        # show at most about 20 labels
+        step = max(1, len(categories) // 20)
+        positions = range(0, len(categories), step)
+        axes.set_xticks(positions)
+        axes.set_xticklabels([categories[i] for i in positions], rotation=45 if step > 1 else 0, fontsize='small')
+        axes.set_xlim(-0.5, len(categories) - 0.5)
+
+    def _draw_lines(self, axes, categories, series, marker, data_labels):
+        for index, item in enumerate(series):
+            values = [columnar.to_float(v, float("nan")) for v in item.get("data", list())]
+            positions = range(len(values))
+            axes.plot(positions, values, label=item.get("name"), color=self._color(item, index),
+                      marker='o' if marker else None, markersize=4, linewidth=2)
+            if data_labels:
+                for x, raw, y in zip(positions, item.get("data", list()), values):
+                    axes.annotate(unicode(raw), (x, y), textcoords="offset points", xytext=(0, 5),
+                                  ha='center', fontsize='x-small')
+
+    def _draw_columns(self, axes, categories, series, column_options):
+        stacking = column_options.get("stacking")
+        data_labels = column_options.get("dataLabels", {}).get("enabled", False)
+        count = max([len(categories)] + [len(item.get("data", list())) for item in series])
+        positions = range(count)
+
+        matrix = list()
+        for item in series:
+            values = [columnar.to_float(v, float("nan")) for v in item.get("data", list())]
+            matrix.append(values + [float("nan")] * (count - len(values)))
+
+        if stacking == "percent":
+            totals = [sum([row[i] for row in matrix if row[i] == row[i]]) for i in positions]
+            matrix = [[100.0 * row[i] / totals[i] if totals[i] else 0.0 for i in positions] for row in matrix]
+
+        bottoms = [0.0] * count
+        bar_width = 0.6 if stacking else 0.8 / max(1, len(series))
+        for index, (item, values) in enumerate(zip(series, matrix)):
+            values = [v if v == v else 0.0 for v in values]
+            if stacking:
+                x = positions
+                bars = axes.bar(x, values, bar_width, bottom=bottoms, label=item.get("name"),
+                                color=self._color(item, index))
+            else:
+                x = [p - 0.4 + bar_width * (index + 0.5) for p in positions]
+                bars = axes.bar(x, values, bar_width, label=item.get("name"), color=self._color(item, index))
+
+            if data_labels:
+                for bar, value in zip(bars, values):
+                    if not value:
+                        continue
+                    label = "%.2f%%" % (value,) if stacking == "percent" else "%g" % (value,)
+                    axes.text(bar.get_x() + bar.get_width() / 2.0, bar.get_y() + bar.get_height() / 2.0, label,
+                              ha='center', va='center', fontsize='x-small',
+                              color=column_options["dataLabels"].get("color", '#000000'))
+            if stacking:
+                bottoms = [b + v for b, v in zip(bottoms, values)]
+
+        if stacking == "percent":
+            axes.set_ylim(0, 100)
+
+
+_backends = {
+    PhantomJSBackend.name: PhantomJSBackend,
+    MatplotlibBackend.name: MatplotlibBackend
+}
+
+_default_backend = PhantomJSBackend()
+
+
+def register_backend(backend_class):
+    """
+    make a ChartBackend subclass selectable by its name
+    """
+    _backends[backend_class.name] = backend_class
+
+
+def get_backend(backend):
+    """
+    :param backend: backend name, or a ChartBackend object
+    :return: ChartBackend object
+    """
+    if isinstance(backend, ChartBackend):
+        return backend
+    if backend not in _backends:
+        raise ChartBackendException("Unknown chart backend: %s" % (backend,))
+    return _backends[backend]()
+
+
+def set_default_backend(backend):
+    """
+    :param backend: backend name, or a ChartBackend object, used by charts without their own backend
+    :return:
+    """
+    global _default_backend
+    _default_backend = get_backend(backend)
+
+
+def get_default_backend():
+    return _default_backend
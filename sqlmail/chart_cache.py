@@ -0,0 +1,171 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class ChartCache(object):
+    """
+    On-disk cache of chart images.
+
+    An image is stored under the hash of the chart options and render parameters,
+    so a chart with the same data is rasterized only once,
+    across runs and across processes sharing cache_dir.
+
+    Files older than max_age seconds are removed,
+    and the least recently used files are removed when cache_dir exceeds max_size bytes.
+    """
+    def __init__(self, cache_dir, max_size=200 * 1024 * 1024, max_age=7 * 24 * 3600):
+        """
+        :param cache_dir: directory to store images
+        :param max_size: max total bytes of images, None for no limit
+        :param max_age: max seconds an image is kept, None for no limit
+        :return:
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.max_age = max_age
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # created by another process
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    @staticmethod
+    def key(options, scale, width, image_format, backend_name="phantomjs", variant=None):
+        """
+        :param variant: other output parameters of the image, such as quality and size budget
+        """
+        content = json.dumps(options, sort_keys=True, separators=(',', ':'))
+        key = "%s|%s|%s|%s|%s" % (content, scale, width, image_format, backend_name)
+        if variant:
+            key += "|%s" % (variant,)
+        return hashlib.sha1(key).hexdigest()
+
+    def _path(self, key, image_format):
+        return os.path.join(self.cache_dir, "%s.%s" % (key, image_format))
+
+    def get(self, key, image_format):
+        """
+        :return: path of the cached image, None if not cached
+        """
+        path = self._path(key, image_format)
+        try:
+            mtime = os.path.getmtime(path)
+            if self.max_age is not None and time.time() - mtime > self.max_age:
+                os.remove(path)
+                path = None
+            else:
+                # mtime is the last use time for LRU eviction
+                os.utime(path, None)
+        except OSError:
+            path = None
+
+        with self.lock:
+            if path:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path
+
+    def put(self, key, image_format, image):
+        """
+        :param image: image content
+        :return: path of the cached image
+        """
+        path = self._path(key, image_format)
+        # write then rename, so other processes never see a half written image
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(image)
+            os.rename(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        self.evict()
+        return path
+
+    def evict(self):
+        now = time.time()
+        files = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if self.max_age is not None and now - stat.st_mtime > self.max_age:
+                self._remove(path)
+            else:
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        if self.max_size is None:
+            return
+
+        total_size = sum([f[1] for f in files])
+        for mtime, size, path in sorted(files):
+            if total_size <= self.max_size:
+                break
+            self._remove(path)
+            total_size -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            # removed by another process
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            self._remove(os.path.join(self.cache_dir, name))
+
+    def stats(self):
+        """
+        :return: dict of hits, misses, number of files and total bytes, for monitoring
+        """
+        files = 0
+        size = 0
+        for name in os.listdir(self.cache_dir):
+            try:
+                size += os.path.getsize(os.path.join(self.cache_dir, name))
+                files += 1
+            except OSError:
+                pass
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "files": files, "size": size}
+
+
+_cache = None
+
+
+def set_cache(cache):
+    """
+    :param cache: ChartCache used by Chart.draw(), None to disable cache
+    :return:
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
@@ -0,0 +1,262 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import atexit
+import base64
+import httplib
+import json
+import logging
+import os
+import platform
+import Queue
+import socket
+import subprocess
+import threading
+import time
+import urllib2
+from traceback import format_exc
+
+
+class ChartServerException(Exception):
+    """Exception when chart server fails to start or render """
+
+
+def phantomjs_command():
+    """
+    :return: [phantomjs binary, highcharts-convert.js] of the bundled phantomjs
+    """
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    if platform.system() == "Linux":
+        exec_file = "phantomjs"
+    else:
+        exec_file = "phantomjs.exe"
+    return ["%s/bin/phantomjs/bin/%s" % (base_path, exec_file),
+            "%s/bin/phantomjs/highcharts-convert.js" % (base_path,)]
+
+
+def _free_port(host):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class ChartServer(object):
+    """
+    One long-lived phantomjs process running highcharts-convert.js in server mode.
+
+    Chart options are POSTed as JSON and the image comes back base64 encoded,
+    so phantomjs and highcharts are loaded only once instead of once per chart.
+    """
+    def __init__(self, host="127.0.0.1", port=None, start_timeout=15, render_timeout=60):
+        """
+        :param host: interface the server listens on
+        :param port: port the server listens on, a free port is picked if None
+        :param start_timeout: seconds to wait for the server to become healthy
+        :param render_timeout: seconds to wait for one chart
+        :return:
+        """
+        self.host = host
+        self.port = port
+        self.start_timeout = start_timeout
+        self.render_timeout = render_timeout
+
+        self.process = None
+        self.last_check = 0
+
+    @property
+    def url(self):
+        return "http://%s:%d/" % (self.host, self.port)
+
+    def start(self):
+        if self.is_alive():
+            return
+
+        if self.port is None:
+            self.port = _free_port(self.host)
+
+        phantomjs, convert_js = phantomjs_command()
+        with open(os.devnull, 'w') as devnull:
+            # run in the script directory so highcharts-convert.js finds highstock.js etc.
+            self.process = subprocess.Popen([phantomjs, convert_js, "-host", self.host, "-port", str(self.port)],
+                                            cwd=os.path.dirname(convert_js),
+                                            stdout=devnull, stderr=devnull)
+
+        deadline = time.time() + self.start_timeout
+        while time.time() < deadline:
+            if not self.is_alive():
+                raise ChartServerException("phantomjs exited with code %s on %s" % (self.process.returncode, self.url))
+            if self.ping():
+                return
+            time.sleep(0.1)
+
+        self.stop()
+        raise ChartServerException("phantomjs is not ready on %s after %s seconds" % (self.url, self.start_timeout))
+
+    def stop(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def ping(self):
+        """ health check supported by highcharts-convert.js: {"status": ...} is answered with OK """
+        try:
+            result = self._post({"status": "ping"}, timeout=2)
+        except (urllib2.URLError, socket.error, httplib.HTTPException):
+            return False
+        self.last_check = time.time()
+        return result == "OK"
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        """
+        :param options: highcharts options dict
+        :param scale: zoom factor, ignored by highcharts-convert.js when width is set
+        :param width: image width in pixels
+        :param image_format: jpg, png or svg
+        :return: image content
+        """
+        params = {
+            "infile": json.JSONEncoder().encode(options),
+            "outfile": "chart.%s" % (image_format,),
+            "scale": scale,
+            "width": width
+        }
+        result = self._post(params, timeout=self.render_timeout)
+        if result.startswith("ERROR") or result.startswith("Error"):
+            raise ChartServerException(result)
+
+        if image_format == "svg":
+            return result
+        return base64.b64decode(result)
+
+    def _post(self, params, timeout):
+        request = urllib2.Request(self.url, json.dumps(params), {"Content-Type": "application/json"})
+        response = urllib2.urlopen(request, timeout=timeout)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+
+class ChartServerPool(object):
+    """
+    A fixed number of ChartServer workers shared by all charts.
+
+    Each render borrows one worker. A worker is health checked before use
+    if it has not been checked for health_check_interval seconds,
+    and restarted when it has crashed or fails to render.
+    """
+    def __init__(self, size=2, host="127.0.0.1", start_port=None, health_check_interval=30,
+                 max_retries=1, render_timeout=60):
+        """
+        :param size: number of phantomjs processes
+        :param host: interface the servers listen on
+        :param start_port: servers use start_port, start_port+1, ...; free ports are picked if None
+        :param health_check_interval: seconds between health checks of an idle worker
+        :param max_retries: times to restart a worker and render again after a failure
+        :param render_timeout: seconds to wait for one chart
+        :return:
+        """
+        self.size = size if size >= 1 else 1
+        self.health_check_interval = health_check_interval
+        self.max_retries = max_retries
+
+        self.servers = list()
+        for i in range(self.size):
+            port = start_port + i if start_port else None
+            self.servers.append(ChartServer(host, port, render_timeout=render_timeout))
+
+        self.idle_servers = Queue.Queue()
+        for server in self.servers:
+            self.idle_servers.put(server)
+
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def start(self):
+        for server in self.servers:
+            server.start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        for server in self.servers:
+            server.stop()
+
+    def render(self, options, scale=2.5, width=800, image_format="jpg"):
+        if self.closed:
+            raise ChartServerException("Chart server pool is closed")
+
+        server = self.idle_servers.get()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._check_health(server)
+                    return server.render(options, scale, width, image_format)
+                except (ChartServerException, urllib2.URLError, socket.error, httplib.HTTPException):
+                    logging.error(format_exc())
+                    if attempt >= self.max_retries:
+                        raise ChartServerException("Failed to render chart on %s" % (server.url,))
+                    server.stop()
+        finally:
+            self.idle_servers.put(server)
+
+    def _check_health(self, server):
+        if not server.is_alive():
+            # never started or crashed
+            server.restart()
+        elif time.time() - server.last_check > self.health_check_interval and not server.ping():
+            logging.warning("chart server on %s is not healthy, restart it" % (server.url,))
+            server.restart()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def start_pool(size=2, **kwargs):
+    """
+    start the global chart server pool, used by Chart.draw() once started
+
+    :param size: number of phantomjs processes
+    :param kwargs: other arguments of ChartServerPool
+    :return: the pool
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = ChartServerPool(size, **kwargs)
+    _pool.start()
+    return _pool
+
+
+def get_pool():
+    return _pool
+
+
+def stop_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+        _pool = None
+
+
+atexit.register(stop_pool)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+from collections import OrderedDict
+from itertools import islice
+from operator import itemgetter
+
+
+def to_columns(rows, column_count, batch_size=10000):
+    """
+    turn rows into columns, batch by batch so a stream of rows is never held in memory as rows
+
+    :param rows: list or iterator of row tuples
+    :param column_count: number of columns, so no rows still gives empty columns
+    :param batch_size: number of rows transposed at a time
+    :return: list of columns, each a list of values
+    """
+    columns = [list() for i in range(column_count)]
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        # zip transposes in C, much faster than appending cell by cell
+        for column, values in zip(columns, zip(*batch)):
+            column.extend(values)
+    return columns
+
+
+def take(column, positions):
+    """
+    :return: list of column values at positions
+    """
+    if len(positions) == 1:
+        return [column[positions[0]]]
+    return list(itemgetter(*positions)(column)) if positions else list()
+
+
+def group_positions(columns, key_cols):
+    """
+    like group by in sql, find the rows of each value of key_cols
+
+    :param columns: list of columns
+    :param key_cols: column indexes of the group key
+    :return: OrderedDict in the order groups first appear, key tuple -> list of row positions
+    """
+    groups = OrderedDict()
+    for position, key in enumerate(zip(*[columns[i] for i in key_cols])):
+        positions = groups.get(key)
+        if positions is None:
+            groups[key] = [position]
+        else:
+            positions.append(position)
+    return groups
+
+
+def group_columns(columns, key_cols, value_cols):
+    """
+    split columns into groups by the values of key_cols
+
+    :param columns: list of columns
+    :param key_cols: column indexes of the group key
+    :param value_cols: column indexes of the values
+    :return: OrderedDict in the order groups first appear, key tuple -> list of value columns of the group
+    """
+    return OrderedDict((key, [take(columns[i], positions) for i in value_cols])
+                       for key, positions in group_positions(columns, key_cols).iteritems())
+
+
+def to_float(value, default=None):
+    """
+    :param value: number, or number formatted by sql such as format(value, 0)
+    :param default: returned when value is not a number
+    :return: float
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        try:
+            return float(value.replace(",", ""))
+        except (AttributeError, ValueError):
+            return default
+
+
+def unique(values):
+    """
+    :return: values without duplicates, in the order they first appear
+    """
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
@@ -0,0 +1,427 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import atexit
+import threading
+import time
+
+import MySQLdb
+
+import instrument
+import query_cache
+import thread_util
+
+
+class DBPoolException(Exception):
+    """Exception when no connection can be got from the pool """
+
+
+class ConnectionPool(object):
+    """
+    MySQLdb connections to one server, MySQLdb.connect(**db_info)
+
+    At most max_size connections are open at the same time.
+    Idle connections are closed after idle_timeout seconds,
+    and a stale connection is replaced by a new one when it is taken from the pool.
+    """
+    def __init__(self, db_info, max_size=5, idle_timeout=300, wait_timeout=60):
+        """
+        :param db_info: MySQLdb.connect(**db_info)
+        :param max_size: max number of open connections
+        :param idle_timeout: seconds an unused connection is kept
+        :param wait_timeout: seconds to wait for a connection when all are in use
+        :return:
+        """
+        self.db_info = db_info
+        self.max_size = max_size if max_size >= 1 else 1
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+
+        # (connection, last used time), the last one is the most recently used
+        self.idle_connections = list()
+        self.used_count = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """
+        :return: a connection, give it back by release()
+        """
+        conn = None
+        deadline = time.time() + self.wait_timeout
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise DBPoolException("Connection pool of %s is closed" % (self.db_info.get("host"),))
+
+                self._close_idle()
+                if self.idle_connections:
+                    conn = self.idle_connections.pop()[0]
+                    break
+                if self.used_count < self.max_size:
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DBPoolException("No free connection to %s in %s seconds" % (self.db_info.get("host"),
+                                                                                       self.wait_timeout))
+                self.condition.wait(remaining)
+            self.used_count += 1
+
+        try:
+            if conn is not None and not self._is_alive(conn):
+                self._close(conn)
+                conn = None
+            if conn is None:
+                conn = MySQLdb.connect(**self.db_info)
+        except Exception:
+            with self.condition:
+                self.used_count -= 1
+                self.condition.notify()
+            raise
+        return conn
+
+    def release(self, conn, broken=False):
+        """
+        :param conn: connection got by acquire()
+        :param broken: close the connection instead of reusing it, such as after a lost connection
+        :return:
+        """
+        with self.condition:
+            self.used_count -= 1
+            if broken or self.closed:
+                self._close(conn)
+            else:
+                self.idle_connections.append((conn, time.time()))
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            for conn, last_used in self.idle_connections:
+                self._close(conn)
+            self.idle_connections = list()
+            self.condition.notify_all()
+
+    def _close_idle(self):
+        now = time.time()
+        while self.idle_connections and now - self.idle_connections[0][1] > self.idle_timeout:
+            self._close(self.idle_connections.pop(0)[0])
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            conn.ping()
+            return True
+        except MySQLdb.Error:
+            return False
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
+
+_pools = dict()
+_pools_lock = threading.Lock()
+_pool_options = {"max_size": 5, "idle_timeout": 300, "wait_timeout": 60}
+
+
+def _pool_key(db_info):
+    return tuple(sorted([(k, repr(v)) for k, v in db_info.items()]))
+
+
+def connection_identity(db_info=None, db_conn=None):
+    """
+    :return: a string telling which server and account a query runs on, without the password
+    """
+    if db_conn:
+        try:
+            return "conn:%s" % (db_conn.get_host_info(),)
+        except (AttributeError, MySQLdb.Error):
+            return "conn:%d" % (id(db_conn),)
+    return "info:%r" % (tuple(sorted([(k, v) for k, v in db_info.items() if k not in ("passwd", "password")])),)
+
+
+def set_pool_options(**kwargs):
+    """
+    change max_size, idle_timeout or wait_timeout for pools created later
+    """
+    _pool_options.update(kwargs)
+
+
+def get_pool(db_info):
+    """
+    :param db_info: MySQLdb.connect(**db_info)
+    :return: the ConnectionPool shared by all tables and charts using the same db_info
+    """
+    key = _pool_key(db_info)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(db_info, **_pool_options)
+        return _pools[key]
+
+
+def close_all():
+    """
+    close all pooled connections
+    """
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+atexit.register(close_all)
+
+
+def _execute(db_conn, sql, cursorclass, args=None):
+    with instrument.span("db.query") as query_span:
+        db_cursor = db_conn.cursor(cursorclass=cursorclass) if cursorclass else db_conn.cursor()
+        try:
+            db_cursor.execute(sql, args)
+            db_conn.commit()
+            rows = db_cursor.fetchall()
+            query_span.set("rows", len(rows))
+            return rows, db_cursor.description
+        finally:
+            db_cursor.close()
+
+
+def query(sql, db_info=None, db_conn=None, cursorclass=None, args=None):
+    """
+    execute sql by db_conn, or by a pooled connection of db_info if db_conn is None.
+    With query_cache.set_cache(cache), the same sql is executed once in the cache ttl.
+
+    :param sql: sql to execute
+    :param db_info: MySQLdb.connect(**db_info)
+    :param db_conn: MySQLdb.connect
+    :param cursorclass: such as MySQLdb.cursors.DictCursor
+    :param args: parameters of %s in sql, then a literal % in sql should be %%
+    :return: (rows, cursor description)
+    """
+    cache = query_cache.get_cache()
+    if cache is None:
+        return _query(sql, db_info, db_conn, cursorclass, args)
+    key = cache.key(sql, _cache_identity(db_info, db_conn), cursorclass, args)
+    return cache.get_or_execute(key, lambda: _query(sql, db_info, db_conn, cursorclass, args))
+
+
+_executor = None
+_executor_lock = threading.Lock()
+# one connection cannot execute two sql at the same time, id(db_conn) -> lock
+_conn_locks = dict()
+
+
+def set_executor(executor):
+    """
+    :param executor: thread_util.Executor running queries of query_async, None for a default one of 16 workers
+    :return:
+    """
+    global _executor
+    with _executor_lock:
+        _executor = executor
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = thread_util.Executor(16)
+        return _executor
+
+
+def _shutdown_executor():
+    with _executor_lock:
+        if _executor is not None:
+            # like concurrent.futures, submitted queries are finished before exit
+            _executor.shutdown()
+
+
+atexit.register(_shutdown_executor)
+
+
+def _query_conn(sql, db_conn, cursorclass, args):
+    with _executor_lock:
+        lock = _conn_locks.setdefault(id(db_conn), threading.Lock())
+    with lock:
+        return query(sql, None, db_conn, cursorclass, args)
+
+
+def query_async(sql, db_info=None, db_conn=None, cursorclass=None, args=None):
+    """
+    same as query, but returns at once and the sql is executed by the executor of set_executor.
+    Queries of one db_info run at the same time on pooled connections, up to max_size of the pool,
+    queries of one db_conn run one by one.
+
+    :return: thread_util.Future of (rows, cursor description)
+    """
+    if db_conn:
+        return get_executor().submit(_query_conn, sql, db_conn, cursorclass, args)
+    return get_executor().submit(query, sql, db_info, None, cursorclass, args)
+
+
+def fetch(sql, db_info=None, db_conn=None, stream=False, batch_size=1000, watermark_col=None, window=None,
+          result=None, dict_rows=False):
+    """
+    rows of a table, chart or data source, the one data path shared by SQLTable, MultiSQLTable and charts
+
+    :param sql: sql to execute
+    :param db_info: MySQLdb.connect(**db_info)
+    :param db_conn: MySQLdb.connect
+    :param stream: a QueryStream read batch by batch by a server-side cursor, instead of all rows
+    :param batch_size: number of rows fetched at a time in stream mode
+    :param watermark_col: column that grows over time, rows are fetched by incremental.query
+    :param window: (start, end) of the rolling window, required with watermark_col
+    :param result: (rows, cursor description) of sql already executed, returned as it is
+    :param dict_rows: rows as dicts of column name -> value instead of tuples
+    :return: (rows or QueryStream, cursor description)
+    """
+    # incremental imports db_pool, so it is imported here
+    import incremental
+
+    if result is not None:
+        return result
+    if stream:
+        cursorclass = MySQLdb.cursors.SSDictCursor if dict_rows else MySQLdb.cursors.SSCursor
+        rows = QueryStream(sql, db_info, db_conn, batch_size, cursorclass)
+        return rows, rows.description
+    cursorclass = MySQLdb.cursors.DictCursor if dict_rows else None
+    if watermark_col:
+        return incremental.query(sql, watermark_col, window, db_info, db_conn, cursorclass)
+    return query(sql, db_info, db_conn, cursorclass)
+
+
+def build_async(factory, error_class, sql, db_info=None, db_conn=None, **kwargs):
+    """
+    factory(sql, db_info, db_conn, **kwargs) without waiting for the sql, the from_query of tables and charts.
+    The sql is executed by query_async, then factory gets its result by result=,
+    a stream or incremental sql is executed by factory itself in the executor.
+
+    :param factory: SQLTable, SQLLineChart or SQLStackChart
+    :param error_class: exception factory raises when the sql fails, such as TableInitException,
+                        a failed query_async raises it too
+    :return: thread_util.Future of what factory returns
+    """
+    if kwargs.get("stream") or kwargs.get("watermark_col"):
+        return get_executor().submit(factory, sql, db_info, db_conn, **kwargs)
+
+    def fail(e):
+        raise error_class(e.message)
+    return query_async(sql, db_info, db_conn).then(lambda result: factory(sql, result=result, **kwargs), fail)
+
+
+def invalidate_cache(sql=None, db_info=None, db_conn=None):
+    """
+    forget cached results of a sql, or all cached results if sql is None
+
+    :param sql: sql to forget
+    :param db_info: MySQLdb.connect(**db_info)
+    :param db_conn: MySQLdb.connect
+    :return:
+    """
+    cache = query_cache.get_cache()
+    if cache is None:
+        return
+    if sql is None:
+        cache.invalidate()
+    else:
+        cache.invalidate(sql, _cache_identity(db_info, db_conn))
+
+
+def _cache_identity(db_info, db_conn):
+    # host info cannot tell two connections to one server apart, results of db_conn are kept apart
+    if db_conn:
+        return "%s:%d" % (connection_identity(None, db_conn), id(db_conn))
+    return connection_identity(db_info)
+
+
+def _query(sql, db_info, db_conn, cursorclass, args):
+    if db_conn:
+        return _execute(db_conn, sql, cursorclass, args)
+
+    pool = get_pool(db_info)
+    conn = pool.acquire()
+    try:
+        result = _execute(conn, sql, cursorclass, args)
+    except MySQLdb.OperationalError:
+        # connection may be lost, never reuse it
+        pool.release(conn, broken=True)
+        raise
+    except Exception:
+        pool.release(conn)
+        raise
+    pool.release(conn)
+    return result
+
+
+class QueryStream(object):
+    """
+    rows of a sql read batch by batch from a server-side cursor,
+    so the whole result set is never held in memory.
+
+    The rows can be iterated only once. The connection is busy until all rows are read,
+    then it is given back to the pool (or left open if it is db_conn).
+    """
+    def __init__(self, sql, db_info=None, db_conn=None, batch_size=1000, cursorclass=None):
+        """
+        :param sql: sql to execute
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param batch_size: number of rows fetched at a time
+        :param cursorclass: server-side cursor class, default is MySQLdb.cursors.SSCursor
+        :return:
+        """
+        self.batch_size = batch_size
+        self.pool = None if db_conn else get_pool(db_info)
+        self.db_conn = db_conn if db_conn else self.pool.acquire()
+        self.db_cursor = None
+        self.consumed = False
+        try:
+            with instrument.span("db.query_stream"):
+                self.db_cursor = self.db_conn.cursor(cursorclass=cursorclass or MySQLdb.cursors.SSCursor)
+                self.db_cursor.execute(sql)
+                self.description = self.db_cursor.description
+        except Exception:
+            self._release(broken=True)
+            raise
+
+    def __iter__(self):
+        if self.consumed:
+            raise DBPoolException("Rows of a query stream can be read only once")
+        self.consumed = True
+
+        broken = True
+        try:
+            while True:
+                rows = self.db_cursor.fetchmany(self.batch_size)
+                if not rows:
+                    break
+                for r in rows:
+                    yield r
+            broken = False
+        finally:
+            self.close(broken)
+
+    def close(self, broken=False):
+        """
+        stop reading rows and give back the connection
+        """
+        if self.db_cursor is None:
+            return
+        try:
+            self.db_cursor.close()
+            self.db_conn.commit()
+        except MySQLdb.Error:
+            broken = True
+        self.db_cursor = None
+        self._release(broken)
+
+    def _release(self, broken=False):
+        if self.pool is not None:
+            # a cursor closed before all rows are read leaves the connection unusable
+            self.pool.release(self.db_conn, broken=broken)
+            self.pool = None
@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import columnar
+
+
+class DownsampleException(Exception):
+    """Exception when the downsampling method is unknown """
+
+
+def lttb(values, points):
+    """
+    Largest-Triangle-Three-Buckets: keep the points that make the largest triangles
+    with their neighbours, so the shape and the peaks of the line stay.
+
+    :param values: y values at x = 0, 1, 2...
+    :param points: number of points to keep, at least 3
+    :return: sorted indexes of kept values
+    """
+    count = len(values)
+    if points >= count or points < 3:
+        return range(count)
+
+    ys = [columnar.to_float(v) for v in values]
+    indexes = [0]
+    # first and last points are always kept, the rest are split into points - 2 buckets
+    bucket_size = float(count - 2) / (points - 2)
+    a = 0
+    for bucket in range(points - 2):
+        start = int(bucket * bucket_size) + 1
+        end = int((bucket + 1) * bucket_size) + 1
+
+        # average of the next bucket is the third point of the triangle
+        next_start = end
+        next_end = min(int((bucket + 2) * bucket_size) + 1, count)
+        next_values = [y for y in ys[next_start:next_end] if y is not None]
+        avg_x = (next_start + next_end - 1) / 2.0
+        avg_y = sum(next_values) / len(next_values) if next_values else None
+
+        a_y = ys[a]
+        chosen = start
+        max_area = -1.0
+        for i in range(start, end):
+            y = ys[i]
+            if y is None:
+                continue
+            if a_y is None or avg_y is None:
+                # cannot measure the triangle, keep the largest absolute value
+                area = abs(y)
+            else:
+                area = abs((a - avg_x) * (y - a_y) - (a - i) * (avg_y - a_y))
+            if area > max_area:
+                max_area = area
+                chosen = i
+        indexes.append(chosen)
+        a = chosen
+
+    indexes.append(count - 1)
+    return indexes
+
+
+def min_max(values, points):
+    """
+    keep the smallest and the largest value of each bucket, so no peak is lost
+
+    :param values: y values at x = 0, 1, 2...
+    :param points: number of points to keep, about 2 in each bucket
+    :return: sorted indexes of kept values
+    """
+    count = len(values)
+    if points >= count or points < 2:
+        return range(count)
+
+    ys = [columnar.to_float(v) for v in values]
+    buckets = points // 2
+    bucket_size = float(count) / buckets
+    indexes = set([0, count - 1])
+    for bucket in range(buckets):
+        start = int(bucket * bucket_size)
+        end = int((bucket + 1) * bucket_size)
+        numbers = [(ys[i], i) for i in range(start, end) if ys[i] is not None]
+        if numbers:
+            indexes.add(min(numbers)[1])
+            indexes.add(max(numbers)[1])
+    return sorted(indexes)
+
+
+_methods = {
+    "lttb": lttb,
+    "min_max": min_max
+}
+
+
+def downsample_indexes(series_values, points, method="lttb"):
+    """
+    indexes to keep for lines sharing the same x-axis,
+    the union of indexes kept for each line so every line keeps its peaks
+
+    :param series_values: list of y value lists, all of the same length
+    :param points: number of points to keep for each line
+    :param method: lttb or min_max
+    :return: sorted indexes
+    """
+    if method not in _methods:
+        raise DownsampleException("Unknown downsampling method: %s" % (method,))
+    indexes = set()
+    for values in series_values:
+        indexes.update(_methods[method](values, points))
+    return sorted(indexes)
@@ -1,17 +1,43 @@
 #!/usr/bin/python
 # coding:utf-8
+import hashlib
 import time
 import smtplib
+import socket
+import Queue
+from collections import OrderedDict
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.image import MIMEImage
+from email.mime.application import MIMEApplication
+from email import encoders
 from traceback import format_exc
 import logging
 import os
+import re
+import image_util
+import instrument
+import template_util
+import thread_util
 
 class ServerNullException(Exception):
     """Exception that mail server is null """
 
+def is_transient_error(error):
+    """
+    :param error: exception raised when sending a mail
+    :return: True if sending again later may succeed, such as a dropped connection or a 4xx reply,
+             False for permanent errors such as a 5xx reply
+    """
+    if isinstance(error, (smtplib.SMTPServerDisconnected, socket.error)):
+        return True
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all([400 <= code < 500 for code, msg in error.recipients.values()])
+    if isinstance(error, smtplib.SMTPResponseException):
+        return 400 <= error.smtp_code < 500
+    return False
+
+
 class Email(object):
     """connect to some mail server and send content to recipients
 
@@ -42,6 +68,9 @@ class Email(object):
 
         self.msg = None
         self.image_list = list()
+        # sha1 of picture content -> first image part of it
+        self.image_parts = dict()
+        self.attachment_list = list()
         # for child class
         self.additional_content = None
 
@@ -56,8 +85,10 @@ class Email(object):
         if isinstance(value, list):
             self.bcc_list = value
 
-    def _prepare(self):
-
+    def _decode(self):
+        """
+        :return: (content, subject) in unicode, content includes additional_content
+        """
         content = self.additional_content + self.content if self.additional_content else self.content
         subject = self.subject
 
@@ -74,19 +105,51 @@ class Email(object):
         # already unicode
         except TypeError:
             pass
+        return content, subject
 
-        self.msg = MIMEMultipart('related')
-        self.msg['Subject'] = subject
-        self.msg['From'] = self.me
-        self.msg['To'] = ";".join(self.recipients)
-        self.msg['Cc'] = ";".join(self.cc_list)
-        self.msg['Bcc'] = ";".join(self.bcc_list)
-        
-        txt = MIMEText(content.encode('utf-8'), 'html', 'UTF-8')
-        self.msg.attach(txt)
+    def _prepare(self):
+        with instrument.span("mail.prepare", widget=self.subject) as prepare_span:
+            content, subject = self._decode()
+
+            self.msg = MIMEMultipart('related')
+            self.msg['Subject'] = subject
+            self.msg['From'] = self.me
+            self.msg['To'] = ";".join(self.recipients)
+            self.msg['Cc'] = ";".join(self.cc_list)
+            self.msg['Bcc'] = ";".join(self.bcc_list)
+
+            content, images = self._unique_images(content)
+            txt = MIMEText(content.encode('utf-8'), 'html', 'UTF-8')
+            self.msg.attach(txt)
+
+            for image in images:
+                self.msg.attach(image)
+            for attachment in self.attachment_list:
+                self.msg.attach(attachment)
+            prepare_span.set("bytes", len(content))
+            prepare_span.set("images", len(images))
+            prepare_span.set("duplicate_images", len(self.image_list) - len(images))
+
+    def _unique_images(self, content):
+        """
+        the same picture added with different cid tags, such as a logo or a chart shown twice, is sent once
 
+        :return: (content with cid tags of the same picture changed to the first one, image parts to send)
+        """
+        images = list()
+        first_cids = dict()
         for image in self.image_list:
-            self.msg.attach(image)
+            # computed once by add_image_bytes, so personalized mails sharing the parts never hash them again
+            digest = getattr(image, "content_digest", None) or \
+                hashlib.sha1(image.get_payload(decode=True)).hexdigest()
+            cid = image.get('Content-ID', '').strip('<>')
+            if digest not in first_cids:
+                first_cids[digest] = cid
+                images.append(image)
+            elif cid != first_cids[digest]:
+                first_cid = u'cid:%s' % (first_cids[digest],)
+                content = re.sub(r'cid:%s(?=["\'\s)>]|$)' % (re.escape(cid),), lambda m: first_cid, content)
+        return content, images
 
     def add_one_image(self, cid_tag, file_path):
         """
@@ -98,45 +161,277 @@ class Email(object):
         :param file_path: the path of the picture
         :return:
         """
-        image = MIMEImage(open(file_path, 'rb').read())
+        with open(file_path, 'rb') as fd:
+            self.add_image_bytes(cid_tag, fd.read())
+
+    def add_image_bytes(self, cid_tag, data):
+        """
+        same as add_one_image, but the picture is already in memory,
+        such as the result of chart.draw(in_memory=True)
+
+        :param cid_tag: img src tag
+        :param data: picture content, or a file-like object such as StringIO
+        :return:
+        """
+        if hasattr(data, 'read'):
+            data = data.read()
+        data = str(data)
+        digest = hashlib.sha1(data).hexdigest()
+        first = self.image_parts.get(digest)
+        if first is None:
+            # imghdr knows neither webp nor svg
+            image = MIMEImage(data, image_util.image_subtype(data))
+            self.image_parts[digest] = image
+        else:
+            # the same picture is encoded only once
+            image = MIMEImage(data, first.get_content_subtype(), _encoder=encoders.encode_noop)
+            image.set_payload(first.get_payload())
+            image['Content-Transfer-Encoding'] = 'base64'
         image.add_header('Content-ID', '<'+cid_tag+'>')
+        image.content_digest = digest
         self.image_list.append(image)
 
+    def add_attachment(self, filename, data):
+        """
+        attach a file, such as all rows of a table too large for the mail content
+
+        :param filename: file name shown in the mail
+        :param data: file content, or a file-like object
+        :return:
+        """
+        if hasattr(data, 'read'):
+            data = data.read()
+        attachment = MIMEApplication(str(data))
+        attachment.add_header('Content-Disposition', 'attachment', filename=filename)
+        self.attachment_list.append(attachment)
+
     def send_mail(self, mail_server=None, username=None, password=None):
         if mail_server is None:
             raise ServerNullException("Mail server CANNOT be NULL")
 
         self._prepare()
 
-        retry_times = 0
-        # retry every 3 seconds for 100 times
-        while retry_times <= 100:
-            result = self._send_mail(mail_server, username, password)
-            if result:
-                break
-            time.sleep(3)  # wait for 3 seconds
-            retry_times += 1
+        with instrument.span("mail.send", widget=self.subject) as send_span:
+            retry_times = 0
+            # retry every 3 seconds for 100 times
+            while retry_times <= 100:
+                try:
+                    self._send_mail(mail_server, username, password)
+                    send_span.set("sent", 1)
+                    break
+                except Exception as e:
+                    logging.error(format_exc())
+                    if not is_transient_error(e):
+                        # such as a refused recipient or a wrong password, retry never helps
+                        logging.error("give up sending mail: %s" % (self.subject,))
+                        break
+                time.sleep(3)  # wait for 3 seconds
+                retry_times += 1
+            send_span.set("retries", retry_times)
+        self._cleanup()
 
     def _send_mail(self, mail_server, username, password):
-        try:        
-            s = smtplib.SMTP(mail_server)
+        session = SMTPSession(mail_server, username, password)
+        try:
+            session.send(self, prepare=False)
+        finally:
+            session.close()
 
-            if username:
-                try:
-                    s.login(username, password)
-                except smtplib.SMTPAuthenticationError as auth_error:
-                    if auth_error.smtp_code == 530:
-                        s = smtplib.SMTP_SSL(mail_server)
-                        s.login(username, password)
-                    else:
-                        raise auth_error
-
-            s.sendmail(self.me, self.recipients+self.cc_list+self.bcc_list, self.msg.as_string())
-            s.close()
-            return True
+    def _all_recipients(self):
+        return self.recipients + self.cc_list + self.bcc_list
+
+    def _cleanup(self):
+        """ called after the mail is sent, for child class """
+        pass
+
+
+class SMTPSession(object):
+    """
+    an authenticated connection to a mail server, reused by many mails
+
+    The connection is made on the first mail.
+    A connection idle for keepalive_interval seconds is checked by NOOP before use,
+    and a dropped connection is made again.
+    """
+    def __init__(self, mail_server, username=None, password=None, keepalive_interval=30, timeout=60):
+        """
+        :param mail_server: such as smtp.qq.com
+        :param username: login user, no login if None
+        :param password: login password
+        :param keepalive_interval: seconds after which an idle connection is checked by NOOP
+        :param timeout: socket timeout in seconds
+        :return:
+        """
+        if mail_server is None:
+            raise ServerNullException("Mail server CANNOT be NULL")
+
+        self.mail_server = mail_server
+        self.username = username
+        self.password = password
+        self.keepalive_interval = keepalive_interval
+        self.timeout = timeout
+
+        self.smtp = None
+        self.last_used = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def connect(self):
+        self.close()
+        s = smtplib.SMTP(self.mail_server, timeout=self.timeout)
+
+        if self.username:
+            try:
+                s.login(self.username, self.password)
+            except smtplib.SMTPAuthenticationError as auth_error:
+                if auth_error.smtp_code == 530:
+                    s.close()
+                    s = smtplib.SMTP_SSL(self.mail_server, timeout=self.timeout)
+                    s.login(self.username, self.password)
+                else:
+                    s.close()
+                    raise auth_error
+
+        self.smtp = s
+        self.last_used = time.time()
+
+    def close(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            self.smtp.close()
+        self.smtp = None
+
+    def _ensure_connected(self):
+        if self.smtp is None:
+            self.connect()
+        elif time.time() - self.last_used > self.keepalive_interval:
+            try:
+                alive = self.smtp.noop()[0] == 250
+            except (smtplib.SMTPException, socket.error):
+                alive = False
+            if not alive:
+                self.connect()
+
+    def send(self, mail, prepare=True):
+        """
+        :param mail: Email or NiceReportMail
+        :param prepare: build the MIME message of mail first
+        :return:
+        """
+        if prepare:
+            mail._prepare()
+        self.send_message(mail.me, mail._all_recipients(), mail.msg.as_string())
+
+    def send_message(self, me, recipients, message):
+        """
+        send an already built message, such as one spooled by outbox.Outbox
+
+        :param me: envelope sender
+        :param recipients: envelope recipients, a list
+        :param message: message string
+        :return:
+        """
+        with instrument.span("smtp.send") as smtp_span:
+            smtp_span.set("bytes", len(message))
+            smtp_span.set("recipients", len(recipients))
+            self._ensure_connected()
+            try:
+                self._sendmail(me, recipients, message)
+            except (smtplib.SMTPServerDisconnected, socket.error):
+                # dropped by the server while idle, send again by a new connection
+                smtp_span.add("reconnects")
+                self.connect()
+                self._sendmail(me, recipients, message)
+
+    def _sendmail(self, me, recipients, message):
+        try:
+            self.smtp.sendmail(me, recipients, message)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # reset the transaction, so the connection can send the next mail
+            try:
+                self.smtp.rset()
+            except (smtplib.SMTPException, socket.error):
+                self.close()
+            raise
+        finally:
+            self.last_used = time.time()
+
+
+class SMTPPool(object):
+    """
+    a few SMTPSession to one mail server, shared by many mails and threads
+    """
+    def __init__(self, mail_server, username=None, password=None, size=2, **kwargs):
+        """
+        :param mail_server: such as smtp.qq.com
+        :param username: login user, no login if None
+        :param password: login password
+        :param size: number of connections
+        :param kwargs: other arguments of SMTPSession
+        :return:
+        """
+        self.size = size if size >= 1 else 1
+        self.sessions = Queue.Queue()
+        for i in range(self.size):
+            self.sessions.put(SMTPSession(mail_server, username, password, **kwargs))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def send(self, mail):
+        session = self.sessions.get()
+        try:
+            session.send(mail)
+        finally:
+            self.sessions.put(session)
+        try:
+            mail._cleanup()
         except Exception:
+            # the mail is delivered, never report it as failed
             logging.error(format_exc())
-            return False
+
+    def send_many(self, mails):
+        """
+        :param mails: list of Email or NiceReportMail
+        :return: OrderedDict in the order of mails, mail -> None if sent, or mail -> exception
+        """
+        results = OrderedDict()
+        for mail, (result, exc_info) in zip(mails, thread_util.map_in_threads(self.send, mails, self.size)):
+            if exc_info:
+                logging.error("failed to send mail: %s" % (mail.subject,), exc_info=exc_info)
+            results[mail] = exc_info[1] if exc_info else None
+        return results
+
+    def close(self):
+        for i in range(self.size):
+            session = self.sessions.get()
+            session.close()
+            self.sessions.put(session)
+
+
+def send_many(mails, mail_server=None, username=None, password=None, connections=1):
+    """
+    send many mails by a few reused connections instead of one connection per mail
+
+    :param mails: list of Email or NiceReportMail
+    :param mail_server: such as smtp.qq.com
+    :param username: login user, no login if None
+    :param password: login password
+    :param connections: number of connections used at the same time
+    :return: OrderedDict in the order of mails, mail -> None if sent, or mail -> exception
+    """
+    with SMTPPool(mail_server, username, password, connections) as pool:
+        return pool.send_many(mails)
 
 
 class NiceReportMail(Email):
@@ -199,11 +494,8 @@ class NiceReportMail(Email):
         :return:
         """
 
-        path, template_file = os.path.split(mail_template)
-
-        from jinja2 import Environment, FileSystemLoader
-        env = Environment(loader=FileSystemLoader(path))
-        template = env.get_template(template_file)
+        # compiled once per process and cached by template_util
+        template = template_util.get_template(mail_template)
         self.content = template.render(template_data)
 
     def add_images(self, pic_dict):
@@ -216,15 +508,20 @@ class NiceReportMail(Email):
             "cid_tag2": file2
         }
 
+        a value can also be a file-like object such as StringIO(chart.draw(in_memory=True))
+
         :param pic_dict:
         :return:
         """
         if isinstance(pic_dict, dict):
             for tag in pic_dict.keys():
-                self.add_one_image(tag, pic_dict[tag])
-                self.tmp_pic_list.append(pic_dict[tag])
+                if hasattr(pic_dict[tag], 'read'):
+                    self.add_image_bytes(tag, pic_dict[tag])
+                else:
+                    self.add_one_image(tag, pic_dict[tag])
+                    self.tmp_pic_list.append(pic_dict[tag])
 
-    def send_mail(self, mail_server=None, username=None, password=None):
+    def _decode(self):
         if not self.style:
             # set default style
             try:
@@ -236,11 +533,80 @@ class NiceReportMail(Email):
 
         # pass style to parent class by additional_content
         self.additional_content = self.style
-        super(NiceReportMail, self).send_mail(mail_server, username, password)
+        return super(NiceReportMail, self)._decode()
 
+    def _cleanup(self):
         if self.clear_tmp_pic:
             for tmp_file in self.tmp_pic_list:
-                os.remove(tmp_file)
+                try:
+                    os.remove(tmp_file)
+                except OSError as e:
+                    # the mail is already sent, a picture removed by someone else is not an error
+                    logging.warning("failed to remove picture %s: %s" % (tmp_file, e))
+            self.tmp_pic_list = list()
+
+class MailTemplate(object):
+    """
+    A mail built once and sent to many recipients with small differences.
+
+    Content and subject are decoded (with the style of NiceReportMail) only once,
+    and the images are encoded only once and shared by all personalized mails.
+    Only ${name} placeholders in content and subject differ between recipients.
+
+    Example:
+    >>>>report = NiceReportMail('me', subject=u"Report for ${team}", content=u"Hi ${name}, ...")
+    >>>>report.add_images({"chart": chart_file})
+    >>>>template = MailTemplate(report)
+    >>>>mails = [template.personalize([addr], {"name": name, "team": team}) for addr, name, team in users]
+    >>>>send_many(mails, mail_server="smtp.qq.com")
+    """
+    placeholder = re.compile(r"\$\{(\w+)\}")
+
+    def __init__(self, mail):
+        """
+        :param mail: Email or NiceReportMail with content, subject and images
+        :return:
+        """
+        content, subject = mail._decode()
+        self.me = mail.me
+        self.subject = subject
+        self.cc_list = mail.cc_list
+        self.bcc_list = mail.bcc_list
+        self.image_list = mail.image_list
+        self.attachment_list = mail.attachment_list
+
+        # split once, [text, name, text, name, ..., text]
+        self.content_parts = self.placeholder.split(content)
+
+    def _render(self, parts, values):
+        rendered = list(parts)
+        for i in range(1, len(rendered), 2):
+            name = rendered[i]
+            rendered[i] = unicode(values[name]) if name in values else u"${%s}" % (name,)
+        return u"".join(rendered)
+
+    def personalize(self, recipients, values=None, subject=None, cc_list=None, bcc_list=None):
+        """
+        :param recipients: mail recipients, a list
+        :param values: dict of values for ${name} placeholders, inserted as is so html is allowed
+        :param subject: subject instead of the template subject
+        :param cc_list: cc recipients instead of the template ones
+        :param bcc_list: bcc recipients instead of the template ones
+        :return: Email ready to send
+        """
+        values = values or dict()
+        subject = subject if subject is not None else self.subject
+        if subject and "${" in subject:
+            subject = self._render(self.placeholder.split(subject), values)
+
+        mail = Email(self.me, recipients, subject, self._render(self.content_parts, values),
+                     cc_list if cc_list is not None else self.cc_list,
+                     bcc_list if bcc_list is not None else self.bcc_list)
+        # shared images and attachments, already base64 encoded
+        mail.image_list = list(self.image_list)
+        mail.attachment_list = list(self.attachment_list)
+        return mail
+
 
 def test1():
     email = Email(me="kevin<kevin@qq.com>", recipients=["kevin@foxmail.com"],
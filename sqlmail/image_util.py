@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import logging
+from StringIO import StringIO
+
+
+class ImageException(Exception):
+    """Exception when an image cannot be converted """
+
+
+# image_format -> format rendered by chart backends and file extension
+raster_formats = {"jpg": "jpg", "png": "png", "png8": "png", "webp": "webp"}
+
+
+def extension(image_format):
+    """
+    :param image_format: jpg, png, png8, webp or svg
+    :return: file extension of the image
+    """
+    return raster_formats.get(image_format, image_format)
+
+
+def image_subtype(data):
+    """
+    :param data: image content
+    :return: MIME subtype of the image, such as jpeg or svg+xml, None if unknown
+    """
+    if data.startswith("\xff\xd8"):
+        return "jpeg"
+    if data.startswith("\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data[:6] in ("GIF87a", "GIF89a"):
+        return "gif"
+    if data.startswith("RIFF") and data[8:12] == "WEBP":
+        return "webp"
+    head = data[:512].lstrip()
+    if head.startswith("<svg") or (head.startswith("<?xml") and "<svg" in head):
+        return "svg+xml"
+    return None
+
+
+def _pil_image():
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImageException("Pillow is required to convert chart images to png8, webp or a size budget")
+    return Image
+
+
+def _save(image, image_format, quality, colors):
+    output = StringIO()
+    if image_format == "png8":
+        # palette of at most colors colors, charts have few colors so the loss is hardly visible
+        image.convert("RGB").quantize(colors=colors or 256).save(output, format="PNG", optimize=True)
+    elif image_format == "png":
+        image.save(output, format="PNG", optimize=True)
+    elif image_format == "webp":
+        image.save(output, format="WEBP", quality=quality or 80, method=6)
+    elif image_format == "jpg":
+        image.convert("RGB").save(output, format="JPEG", quality=quality or 85, optimize=True)
+    else:
+        raise ImageException("Unknown image format: %s" % (image_format,))
+    return output.getvalue()
+
+
+def encode(image, image_format, quality=None, colors=None, max_bytes=None, min_width=400):
+    """
+    convert a rendered image, and make it smaller until it fits max_bytes
+
+    To fit max_bytes, quality of jpg and webp is lowered down to 40, colors of png8 down to 16,
+    then the image is scaled down, but never below min_width pixels.
+
+    :param image: image content, better lossless such as png
+    :param image_format: jpg, png, png8 or webp
+    :param quality: quality of jpg and webp, 1 - 100
+    :param colors: max number of colors of png8
+    :param max_bytes: size budget of the image, None for no budget
+    :param min_width: smallest width in pixels when scaling down for max_bytes
+    :return: image content
+    """
+    Image = _pil_image()
+    source = Image.open(StringIO(image))
+    source.load()
+    result = _save(source, image_format, quality, colors)
+    if max_bytes is None or len(result) <= max_bytes:
+        return result
+
+    quality = quality or (80 if image_format == "webp" else 85)
+    colors = colors or 256
+    while len(result) > max_bytes:
+        if image_format in ("jpg", "webp") and quality > 40:
+            quality -= 15
+        elif image_format == "png8" and colors > 16:
+            colors //= 2
+        elif source.size[0] * 0.8 >= min_width:
+            size = (int(source.size[0] * 0.8), int(source.size[1] * 0.8))
+            source = source.resize(size, Image.LANCZOS)
+        else:
+            logging.warning("chart image is %d bytes, more than the budget %d bytes" % (len(result), max_bytes))
+            break
+        result = _save(source, image_format, quality, colors)
+    return result
@@ -0,0 +1,190 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import cPickle
+import hashlib
+import os
+import tempfile
+import threading
+
+import db_pool
+import query_cache
+
+
+class IncrementalCacheException(Exception):
+    """Exception when rows cannot be refreshed incrementally """
+
+
+class IncrementalCache(object):
+    """
+    Rows of recurring rolling-window queries, kept on disk and refreshed incrementally.
+
+    The sql declares its window by %(start)s and %(end)s, such as:
+    select ... from kpi where stat_date >= %(start)s and stat_date <= %(end)s
+    and each run passes the window of the day, such as (today - 30 days, today).
+
+    The first run fetches the whole window. Later runs execute the same sql with start set to
+    the last watermark (the last period is fetched again since it may still change),
+    so only the new rows are fetched and the index of the window column is used.
+    Cached rows that fell out of the window are dropped.
+    Rows older than the last watermark are assumed never to change.
+
+    Rows are cached by the sql, not by the window, so the sql should not change from run to run.
+    The watermark column should only grow over time and compare with the window values,
+    such as a date, or a string of date_format(stat_date, '%%Y-%%m-%%d') with window values like '2016-01-05'.
+    Since parameters are used, a literal % in the sql should be %%.
+    """
+    def __init__(self, directory):
+        """
+        :param directory: directory to keep rows, shared by processes
+        :return:
+        """
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+    @staticmethod
+    def _key(sql, watermark_col, db_info, db_conn, cursorclass):
+        normalized_sql = query_cache.normalize_sql(sql)
+        if isinstance(normalized_sql, unicode):
+            normalized_sql = normalized_sql.encode("utf-8")
+        return hashlib.sha1("%s|%s|%s|%s" % (normalized_sql, watermark_col,
+                                             db_pool.connection_identity(db_info, db_conn),
+                                             getattr(cursorclass, "__name__", None))).hexdigest()
+
+    def _load(self, key):
+        try:
+            with open(os.path.join(self.directory, key), 'rb') as fd:
+                return cPickle.load(fd)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+    def _save(self, key, state):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, 'wb') as tmp_file:
+            cPickle.dump(state, tmp_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, os.path.join(self.directory, key))
+
+    def invalidate(self, sql=None, watermark_col=None, db_info=None, db_conn=None, cursorclass=None):
+        """
+        forget the rows of one query, or of all queries if sql is None
+        """
+        if sql is None:
+            names = os.listdir(self.directory)
+        else:
+            names = [self._key(sql, watermark_col, db_info, db_conn, cursorclass)]
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def query(self, sql, watermark_col, window, db_info=None, db_conn=None, cursorclass=None):
+        """
+        :param sql: rolling-window sql with %(start)s and %(end)s
+        :param watermark_col: column name in the sql result
+        :param window: (start, end) of this run, end can be None if the sql has no %(end)s
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param cursorclass: such as MySQLdb.cursors.DictCursor
+        :return: (rows, cursor description), same as db_pool.query(sql, ...)
+        """
+        start, end = window
+        key = self._key(sql, watermark_col, db_info, db_conn, cursorclass)
+        state = self._load(key)
+
+        # a window moved back needs rows never fetched
+        if state is None or not state["rows"] or state.get("start") is None or _less(start, state["start"]):
+            rows, description = db_pool.query(sql, db_info, db_conn, cursorclass, {"start": start, "end": end})
+            get_watermark = self._watermark_getter(rows, description, watermark_col)
+            state = {"rows": list(rows), "description": description,
+                     "order": self._detect_order(rows, get_watermark)}
+        else:
+            state["rows"], state["description"] = self._refresh(state, sql, watermark_col, start, end,
+                                                                db_info, db_conn, cursorclass)
+        state["start"] = start
+
+        with self.lock:
+            self._save(key, state)
+        return state["rows"], state["description"]
+
+    def _refresh(self, state, sql, watermark_col, start, end, db_info, db_conn, cursorclass):
+        cached_rows = state["rows"]
+        get_watermark = self._watermark_getter(cached_rows, state["description"], watermark_col)
+        last_watermark = max([get_watermark(r) for r in cached_rows])
+        fetch_start = start if _less(last_watermark, start) else last_watermark
+        new_rows, description = db_pool.query(sql, db_info, db_conn, cursorclass, {"start": fetch_start, "end": end})
+
+        get_watermark = self._watermark_getter(new_rows, description, watermark_col)
+        merged = [r for r in cached_rows
+                  if not _less(get_watermark(r), start) and _less(get_watermark(r), last_watermark)
+                  and (end is None or not _less(end, get_watermark(r)))]
+        if state["order"] == "desc":
+            merged = list(new_rows) + merged
+            merged.sort(key=get_watermark, reverse=True)
+        else:
+            merged.extend(new_rows)
+            if state["order"] == "asc":
+                merged.sort(key=get_watermark)
+        return merged, description
+
+    @staticmethod
+    def _watermark_getter(rows, description, watermark_col):
+        names = [column[0] for column in description]
+        if watermark_col not in names:
+            raise IncrementalCacheException("Watermark column %s is not in sql result" % (watermark_col,))
+        if rows and isinstance(rows[0], dict):
+            return lambda r: r[watermark_col]
+        index = names.index(watermark_col)
+        return lambda r: r[index]
+
+    @staticmethod
+    def _detect_order(rows, get_watermark):
+        """ asc or desc if rows are sorted by the watermark, so merged rows keep the order """
+        watermarks = [get_watermark(r) for r in rows]
+        if watermarks == sorted(watermarks):
+            return "asc"
+        if watermarks == sorted(watermarks, reverse=True):
+            return "desc"
+        return None
+
+
+def _less(a, b):
+    """ a < b, a date is compared with a date string as str(date) such as 2016-01-05 """
+    if isinstance(a, basestring) != isinstance(b, basestring):
+        a, b = str(a), str(b)
+    return a < b
+
+
+_cache = None
+
+
+def set_cache(cache):
+    """
+    :param cache: IncrementalCache used by tables and charts with watermark_col, None to disable
+    :return:
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
+
+
+def query(sql, watermark_col, window, db_info=None, db_conn=None, cursorclass=None):
+    """
+    query by the IncrementalCache set by set_cache, or a plain db_pool.query of the window if no cache is set
+    """
+    if window is None:
+        raise IncrementalCacheException("A window (start, end) is required with watermark column %s" % (
+            watermark_col,))
+    if _cache is None:
+        return db_pool.query(sql, db_info, db_conn, cursorclass, {"start": window[0], "end": window[1]})
+    return _cache.query(sql, watermark_col, window, db_info, db_conn, cursorclass)
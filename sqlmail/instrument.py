@@ -0,0 +1,308 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+
+
+class Span(object):
+    """
+    one timed stage, such as a query, a chart rendering or a mail sending
+
+    Metrics are numbers recorded in the stage, such as rows, bytes or retries.
+    Tags tell which widget the stage belongs to, such as the chart title.
+    """
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.metrics = dict()
+        self.parent = None
+        self.start_time = None
+        self.duration = None
+        self.error = None
+
+    def set(self, metric, value):
+        self.metrics[metric] = value
+
+    def add(self, metric, value=1):
+        self.metrics[metric] = self.metrics.get(metric, 0) + value
+
+    def __enter__(self):
+        self.parent = self.tracer._push(self)
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.start_time
+        if exc_type is not None:
+            self.error = exc_type.__name__
+        self.tracer._pop(self)
+        self.tracer._export(self)
+
+    @property
+    def widget(self):
+        """ widget tag of this span or of the nearest parent span, such as the table a query runs for """
+        if "widget" in self.tags:
+            return self.tags["widget"]
+        return self.parent.widget if self.parent else None
+
+    @property
+    def path(self):
+        """ names of parent spans and this span, such as table.build/db.query """
+        return "%s/%s" % (self.parent.path, self.name) if self.parent else self.name
+
+
+class _NullSpan(object):
+    """ used when no tracer is set, records nothing """
+    def set(self, metric, value):
+        pass
+
+    def add(self, metric, value=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Tracer(object):
+    """
+    Records spans of the stages of building and sending a report, and passes them to exporters.
+
+    Stages recorded by sqlmail:
+    db.query, db.query_stream, table.build, table.merge, table.to_html,
+    chart.build, chart.options, chart.render, chart.subprocess, chart.encode, mail.prepare, mail.send, smtp.send
+    """
+    def __init__(self, exporters=None):
+        """
+        :param exporters: objects with export(span), such as LoggingExporter
+        :return:
+        """
+        self.exporters = list(exporters) if exporters else list()
+        self.local = threading.local()
+
+    def span(self, name, **tags):
+        """
+        :param name: stage name
+        :param tags: such as widget="Day run"
+        :return: Span, use it by with
+        """
+        return Span(self, name, tags)
+
+    def current(self):
+        """
+        :return: the innermost running span of this thread, or None
+        """
+        stack = getattr(self.local, "stack", None)
+        return stack[-1] if stack else None
+
+    def _push(self, span):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = list()
+        parent = stack[-1] if stack else None
+        stack.append(span)
+        return parent
+
+    def _pop(self, span):
+        stack = self.local.stack
+        if stack and stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            stack.remove(span)
+
+    def _export(self, span):
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                # never fail a report because of monitoring
+                logging.exception("failed to export span %s" % (span.name,))
+
+
+class LoggingExporter(object):
+    """
+    log each span as one line, such as:
+    sqlmail span table.build/db.query 0.120s rows=31
+    """
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger("sqlmail.instrument")
+        self.level = level
+
+    def export(self, span):
+        fields = ["%s=%s" % (k, v) for k, v in sorted(span.tags.items())]
+        fields += ["%s=%s" % (k, v) for k, v in sorted(span.metrics.items())]
+        if span.error:
+            fields.append("error=%s" % (span.error,))
+        self.logger.log(self.level, "sqlmail span %s %.3fs %s" % (span.path, span.duration, " ".join(fields)))
+
+
+def _metric_part(value):
+    """ a widget name as one part of a StatsD metric name """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return re.sub(r"[^A-Za-z0-9_-]", "_", str(value))
+
+
+class StatsDExporter(object):
+    """
+    send each span to a StatsD server over udp:
+    <prefix>.<stage>.<widget>.duration as a timer in ms, each metric as a counter, and <prefix>.<stage>.<widget>.errors,
+    without .<widget> for spans of no widget.
+
+    With dogstatsd=True, metric names have no widget and the widget is sent as a tag, such as |#widget:table_run.
+    """
+    def __init__(self, host="127.0.0.1", port=8125, prefix="sqlmail", dogstatsd=False):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.dogstatsd = dogstatsd
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, span):
+        name = "%s.%s" % (self.prefix, span.name)
+        widget = span.widget
+        tags = ""
+        if widget is not None:
+            if self.dogstatsd:
+                tags = "|#widget:%s" % (_metric_part(widget),)
+            else:
+                name = "%s.%s" % (name, _metric_part(widget))
+        lines = ["%s.duration:%d|ms%s" % (name, span.duration * 1000, tags)]
+        lines += ["%s.%s:%s|c%s" % (name, k, v, tags) for k, v in sorted(span.metrics.items())]
+        if span.error:
+            lines.append("%s.errors:1|c%s" % (name, tags))
+        try:
+            self.sock.sendto("\n".join(lines), self.address)
+        except socket.error:
+            # statsd is best effort
+            pass
+
+
+class PrometheusFileExporter(object):
+    """
+    keep totals of spans by stage and widget, and write them in the Prometheus text format,
+    for the textfile collector of node_exporter:
+
+    <prefix>_stage_total{stage="chart.render",widget="Day run"} 12
+    <prefix>_stage_errors_total{stage="chart.render",widget="Day run"} 0
+    <prefix>_stage_seconds_total{stage="chart.render",widget="Day run"} 8.5
+    <prefix>_stage_<metric>_total{stage="chart.render",widget="Day run"} 612345
+
+    widget is "" for spans of no widget.
+    """
+    def __init__(self, path, prefix="sqlmail", min_interval=1):
+        """
+        :param path: file to write, such as /var/lib/node_exporter/sqlmail.prom
+        :param prefix: prefix of metric names
+        :param min_interval: seconds between two writes, totals are always written by flush()
+        :return:
+        """
+        self.path = path
+        self.prefix = prefix
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        # (stage, widget) -> {count, errors, seconds, metrics}
+        self.totals = dict()
+        self.last_write = 0
+
+    def export(self, span):
+        with self.lock:
+            widget = span.widget
+            key = (span.name, u"" if widget is None else widget)
+            total = self.totals.setdefault(key, {"count": 0, "errors": 0, "seconds": 0.0, "metrics": dict()})
+            total["count"] += 1
+            total["seconds"] += span.duration
+            if span.error:
+                total["errors"] += 1
+            for k, v in span.metrics.items():
+                if isinstance(v, (int, long, float)):
+                    total["metrics"][k] = total["metrics"].get(k, 0) + v
+            if time.time() - self.last_write >= self.min_interval:
+                self._write()
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    @staticmethod
+    def _labels(labels):
+        stage, widget = labels
+        if not isinstance(widget, unicode):
+            widget = str(widget).decode("utf-8")
+        widget = widget.replace(u"\\", u"\\\\").replace(u'"', u'\\"').replace(u"\n", u"\\n")
+        return u'stage="%s",widget="%s"' % (stage, widget)
+
+    def _write(self):
+        lines = list()
+        for suffix, help_text in (("stage_total", "number of stage runs"),
+                                  ("stage_errors_total", "number of failed stage runs"),
+                                  ("stage_seconds_total", "seconds spent in stage")):
+            lines.append("# HELP %s_%s %s" % (self.prefix, suffix, help_text))
+            lines.append("# TYPE %s_%s counter" % (self.prefix, suffix))
+            key = {"stage_total": "count", "stage_errors_total": "errors", "stage_seconds_total": "seconds"}[suffix]
+            for labels, total in sorted(self.totals.items()):
+                lines.append('%s_%s{%s} %s' % (self.prefix, suffix, self._labels(labels), total[key]))
+
+        metric_names = sorted(set(k for total in self.totals.values() for k in total["metrics"]))
+        for metric in metric_names:
+            lines.append("# TYPE %s_stage_%s_total counter" % (self.prefix, metric))
+            for labels, total in sorted(self.totals.items()):
+                if metric in total["metrics"]:
+                    lines.append('%s_stage_%s_total{%s} %s' % (self.prefix, metric, self._labels(labels),
+                                                               total["metrics"][metric]))
+
+        content = u"\n".join([line if isinstance(line, unicode) else line.decode("utf-8") for line in lines])
+        # write then rename, so the collector never reads a half written file
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(content.encode("utf-8") + "\n")
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, self.path)
+        self.last_write = time.time()
+
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """
+    :param tracer: Tracer that records stages of all tables, charts and mails, None to disable
+    :return:
+    """
+    global _tracer
+    _tracer = tracer
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, **tags):
+    """
+    :return: a span of the tracer set by set_tracer, or a span recording nothing if no tracer is set
+    """
+    if _tracer is None:
+        return _null_span
+    return _tracer.span(name, **tags)
+
+
+def current_span():
+    """
+    :return: the innermost running span of this thread, a span recording nothing if there is none
+    """
+    if _tracer is None:
+        return _null_span
+    return _tracer.current() or _null_span
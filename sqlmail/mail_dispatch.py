@@ -0,0 +1,253 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import atexit
+import logging
+import random
+import sys
+import threading
+import time
+import Queue
+from traceback import format_exc
+
+import email_util
+import instrument
+
+
+class MailDispatchException(Exception):
+    """Exception when a mail is not sent by the dispatcher """
+
+
+class RetryPolicy(object):
+    """
+    exponential backoff with jitter: base_delay, 2 * base_delay, 4 * base_delay ... up to max_delay,
+    each delay randomly shortened by up to jitter of itself
+    """
+    def __init__(self, max_retries=5, base_delay=2, max_delay=60, jitter=0.5):
+        """
+        :param max_retries: times to send again after a transient error
+        :param base_delay: seconds before the first retry
+        :param max_delay: max seconds between retries
+        :param jitter: 0 ~ 1, random part of each delay, so mails do not retry all at once
+        :return:
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, retry_times):
+        """
+        :param retry_times: 0 for the first retry
+        :return: seconds to wait
+        """
+        delay = min(self.max_delay, self.base_delay * (2 ** retry_times))
+        return delay * (1 - self.jitter * random.random())
+
+
+class SendHandle(object):
+    """
+    returned by MailDispatcher.submit at once, the mail is sent in the background
+    """
+    def __init__(self, mail):
+        self.mail = mail
+        self.attempts = 0
+        self.error = None
+        self.finished = threading.Event()
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :return: True if the mail is sent or failed in timeout seconds
+        """
+        self.finished.wait(timeout)
+        return self.finished.is_set()
+
+    def result(self, timeout=None):
+        """
+        wait for the mail and raise the error if it failed
+
+        :return: number of attempts
+        """
+        if not self.wait(timeout):
+            raise MailDispatchException("Mail is not sent in %s seconds: %s" % (timeout, self.mail.subject))
+        if self.error is not None:
+            raise self.error
+        return self.attempts
+
+    def _finish(self, error=None):
+        self.error = error
+        self.finished.set()
+
+
+class MailDispatcher(object):
+    """
+    send mails by background workers, so the caller never waits for the mail server
+
+    Each worker keeps one SMTPSession. A transient error (dropped connection, 4xx reply)
+    sends the mail again after a backoff delay without blocking the worker,
+    and a permanent error (5xx reply) fails the mail at once.
+
+    Call close() or flush() before exit to deliver the queued mails, close() is also called at exit.
+    """
+    def __init__(self, mail_server=None, username=None, password=None, workers=2, retry_policy=None):
+        """
+        :param mail_server: such as smtp.qq.com
+        :param username: login user, no login if None
+        :param password: login password
+        :param workers: number of background threads and connections
+        :param retry_policy: RetryPolicy, default is RetryPolicy()
+        :return:
+        """
+        if mail_server is None:
+            raise email_util.ServerNullException("Mail server CANNOT be NULL")
+
+        self.mail_server = mail_server
+        self.username = username
+        self.password = password
+        self.retry_policy = retry_policy or RetryPolicy()
+
+        self.queue = Queue.Queue()
+        # handles submitted but not finished, including those waiting for a retry
+        self.pending = set()
+        self.timers = set()
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.workers = list()
+        for i in range(max(1, workers)):
+            worker = threading.Thread(target=self._work, name="mail-dispatch-%d" % (i,))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def submit(self, mail):
+        """
+        :param mail: Email or NiceReportMail
+        :return: SendHandle
+        """
+        handle = SendHandle(mail)
+        with self.condition:
+            if self.closed:
+                raise MailDispatchException("Mail dispatcher is closed")
+            self.pending.add(handle)
+        self.queue.put(handle)
+        return handle
+
+    def flush(self, timeout=None):
+        """
+        wait until all submitted mails are sent or failed
+
+        :return: True if nothing is pending
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.pending:
+                remaining = 1 if deadline is None else deadline - time.time()
+                if remaining <= 0:
+                    break
+                # wait by pieces, so KeyboardInterrupt still works
+                self.condition.wait(min(remaining, 1))
+            return not self.pending
+
+    def close(self, wait=True, timeout=None):
+        """
+        stop the workers
+
+        :param wait: deliver pending mails first, otherwise fail them
+        :param timeout: max seconds to wait for pending mails
+        :return:
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+
+        if wait:
+            self.flush(timeout)
+
+        with self.condition:
+            for timer in self.timers:
+                timer.cancel()
+            self.timers.clear()
+            for handle in list(self.pending):
+                self._finish(handle, MailDispatchException("Mail dispatcher is closed before sending"))
+
+        for worker in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def _work(self):
+        session = email_util.SMTPSession(self.mail_server, self.username, self.password)
+        try:
+            while True:
+                handle = self.queue.get()
+                if handle is None:
+                    return
+                if handle.done():
+                    continue
+                try:
+                    self._send(session, handle)
+                except Exception:
+                    # never let one mail stop the worker
+                    logging.error(format_exc())
+                    self._finish(handle, sys.exc_info()[1])
+        finally:
+            session.close()
+
+    def _send(self, session, handle):
+        handle.attempts += 1
+        with instrument.span("mail.send", widget=handle.mail.subject) as send_span:
+            send_span.set("retries", handle.attempts - 1)
+            try:
+                session.send(handle.mail)
+                send_span.set("sent", 1)
+            except Exception:
+                error = sys.exc_info()[1]
+                logging.error(format_exc())
+                retry_times = handle.attempts - 1
+                if email_util.is_transient_error(error) and retry_times < self.retry_policy.max_retries:
+                    self._retry_later(handle, self.retry_policy.delay(retry_times))
+                else:
+                    self._finish(handle, error)
+                return
+
+        try:
+            handle.mail._cleanup()
+        except Exception:
+            # the mail is delivered, so the handle still finishes without error
+            logging.error(format_exc())
+        finally:
+            self._finish(handle)
+
+    def _retry_later(self, handle, delay):
+        def retry():
+            with self.condition:
+                self.timers.discard(timer)
+            self.queue.put(handle)
+
+        timer = threading.Timer(delay, retry)
+        timer.daemon = True
+        with self.condition:
+            self.timers.add(timer)
+        timer.start()
+
+    def _finish(self, handle, error=None):
+        with self.condition:
+            if handle.done():
+                return
+            handle._finish(error)
+            self.pending.discard(handle)
+            self.condition.notify_all()
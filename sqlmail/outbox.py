@@ -0,0 +1,245 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from traceback import format_exc
+
+import email_util
+
+
+class OutboxException(Exception):
+    """Exception when a mail cannot be put into the outbox """
+
+
+# sending/ files claimed by this process, a claim with our pid not in it is left by a crashed process
+_claims = set()
+_claims_lock = threading.Lock()
+
+
+class Outbox(object):
+    """
+    A spool directory of built mails.
+
+    put() saves the MIME message right after _prepare(), so the expensive sql and chart work
+    is never done again if the process dies before the mail is sent.
+    drain() sends the spooled mails, also from another or a restarted process.
+
+    A mail put with an idempotency key is not put again while that key is in the outbox or already sent.
+    A mail put without a key gets a new unique key, so the same content can be sent again later.
+    The key is used as Message-ID. A process killed after the server accepted a mail
+    but before it was marked as sent will send it once more, with the same Message-ID.
+
+    directory/
+        new/      mails to send
+        sending/  mails being sent, <key>.<pid>
+        sent/     sent mails
+        failed/   mails refused by the server
+    """
+    def __init__(self, directory):
+        """
+        :param directory: spool directory, shared by all processes using this outbox
+        :return:
+        """
+        self.directory = directory
+        for sub_dir in ("new", "sending", "sent", "failed"):
+            path = os.path.join(directory, sub_dir)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created by another process
+                    if not os.path.isdir(path):
+                        raise
+
+    def _path(self, sub_dir, name):
+        return os.path.join(self.directory, sub_dir, name)
+
+    @staticmethod
+    def mail_key(mail):
+        """
+        hash of sender, recipients, subject, content, images and attachments,
+        put(mail, key=Outbox.mail_key(mail)) never sends the same mail twice, even on another day
+        """
+        key = hashlib.sha1()
+        for value in [mail.me, mail.subject, mail.additional_content, mail.content]:
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            key.update(repr(value))
+        for address in mail._all_recipients():
+            key.update(address)
+        for part in mail.image_list + mail.attachment_list:
+            key.update(part.get_payload())
+        return key.hexdigest()
+
+    def put(self, mail, key=None):
+        """
+        build the mail and save it into the outbox
+
+        :param mail: Email or NiceReportMail
+        :param key: idempotency key such as "daily-report-20160102-team1",
+                    None for a new unique key, the mail is then never deduplicated
+        :return: the key
+        """
+        mail._prepare()
+        key = key or uuid.uuid4().hex
+        if not key.replace("-", "").replace("_", "").replace(".", "").isalnum():
+            raise OutboxException("Key should only contain letters, digits, '-', '_' and '.': %s" % (key,))
+
+        if self.contains(key):
+            logging.info("mail %s is already in outbox" % (key,))
+            return key
+
+        del mail.msg['Message-ID']
+        mail.msg['Message-ID'] = "<%s@sqlmail>" % (key,)
+        item = {
+            "key": key,
+            "me": mail.me,
+            "recipients": mail._all_recipients(),
+            "message": mail.msg.as_string(),
+            "created": time.time()
+        }
+
+        # write then rename, so drain() never sees a half written mail
+        fd, tmp_path = tempfile.mkstemp(dir=self._path("new", ""), suffix=".tmp")
+        with os.fdopen(fd, 'w') as tmp_file:
+            json.dump(item, tmp_file)
+        os.rename(tmp_path, self._path("new", key))
+        mail._cleanup()
+        return key
+
+    def contains(self, key):
+        """
+        :return: True if the mail of key is waiting, being sent or already sent
+        """
+        if os.path.exists(self._path("new", key)) or os.path.exists(self._path("sent", key)):
+            return True
+        return any([name.rsplit(".", 1)[0] == key for name in os.listdir(self._path("sending", ""))])
+
+    def pending(self):
+        """
+        :return: keys of mails to send, oldest first
+        """
+        names = [name for name in os.listdir(self._path("new", "")) if not name.endswith(".tmp")]
+        return sorted(names, key=lambda name: self._mtime(self._path("new", name)))
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    def drain(self, mail_server=None, username=None, password=None, session=None):
+        """
+        send all mails in the outbox
+
+        A mail with a transient error stays in the outbox for the next drain,
+        a mail refused by the server is moved to failed/.
+
+        :param mail_server: such as smtp.qq.com
+        :param username: login user, no login if None
+        :param password: login password
+        :param session: an email_util.SMTPSession to use instead of mail_server
+        :return: dict of sent, failed and deferred counts
+        """
+        self.recover()
+
+        own_session = session is None
+        if own_session:
+            session = email_util.SMTPSession(mail_server, username, password)
+
+        counts = {"sent": 0, "failed": 0, "deferred": 0}
+        try:
+            for key in self.pending():
+                result = self._send_one(session, key)
+                if result:
+                    counts[result] += 1
+        finally:
+            if own_session:
+                session.close()
+        return counts
+
+    def _send_one(self, session, key):
+        sending_path = self._path("sending", "%s.%d" % (key, os.getpid()))
+        try:
+            # claim the mail, another process draining at the same time gets an error
+            os.rename(self._path("new", key), sending_path)
+        except OSError:
+            return None
+
+        with _claims_lock:
+            _claims.add(os.path.abspath(sending_path))
+        try:
+            return self._send_claimed(session, key, sending_path)
+        finally:
+            with _claims_lock:
+                _claims.discard(os.path.abspath(sending_path))
+
+    def _send_claimed(self, session, key, sending_path):
+        if os.path.exists(self._path("sent", key)):
+            os.remove(sending_path)
+            return None
+
+        with open(sending_path) as fd:
+            item = json.load(fd)
+        try:
+            session.send_message(item["me"], item["recipients"], item["message"])
+        except Exception as e:
+            logging.error(format_exc())
+            if email_util.is_transient_error(e):
+                os.rename(sending_path, self._path("new", key))
+                return "deferred"
+            os.rename(sending_path, self._path("failed", key))
+            return "failed"
+
+        os.rename(sending_path, self._path("sent", key))
+        return "sent"
+
+    def recover(self):
+        """
+        put mails claimed by dead processes back to new/
+        """
+        for name in os.listdir(self._path("sending", "")):
+            key, pid = name.rsplit(".", 1)
+            if not self._claim_alive(self._path("sending", name), int(pid)):
+                try:
+                    os.rename(self._path("sending", name), self._path("new", key))
+                except OSError:
+                    pass
+
+    def _claim_alive(self, path, pid):
+        if pid == os.getpid():
+            # a restarted process often gets the pid of the crashed one, such as 1 in a container
+            with _claims_lock:
+                return os.path.abspath(path) in _claims
+        return self._process_alive(pid)
+
+    @staticmethod
+    def _process_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.EPERM
+        return True
+
+    def purge_sent(self, max_age=7 * 24 * 3600):
+        """
+        remove sent mails older than max_age seconds, their keys can be put again afterwards
+        """
+        now = time.time()
+        for name in os.listdir(self._path("sent", "")):
+            path = self._path("sent", name)
+            if now - self._mtime(path) > max_age:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
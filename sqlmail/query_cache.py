@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import cPickle
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+# quoted literals and identifiers are kept as they are, other whitespace is collapsed
+_sql_tokens = re.compile(r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+
+def normalize_sql(sql):
+    """
+    :return: sql with whitespace outside quoted literals collapsed, so differently indented sql shares a key
+    """
+    return _sql_tokens.sub(lambda m: m.group(1) or " ", sql.strip().rstrip(";").strip())
+
+
+def result_size(result):
+    """
+    :param result: (rows, cursor description)
+    :return: estimated bytes of the rows in memory, measured on up to 100 rows
+    """
+    rows = result[0]
+    if not rows:
+        return 0
+    sample = rows[:100]
+    size = 0
+    for row in sample:
+        values = row.values() if isinstance(row, dict) else row
+        size += sys.getsizeof(row) + sum([sys.getsizeof(v) for v in values])
+    return size * len(rows) // len(sample)
+
+
+class MemoryStorage(object):
+    """
+    Query results in a dict of this process, at most max_entries of them and at most max_bytes in total.
+    The least recently used result is dropped first.
+    """
+    def __init__(self, max_entries=256, max_bytes=256 * 1024 * 1024):
+        """
+        :param max_entries: max number of results, None for no limit
+        :param max_bytes: max estimated bytes of all results, None for no limit.
+                          A result larger than that is not cached.
+        :return:
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key: (expire time, result, bytes), the last one is the most recently used
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self.total_bytes -= entry[2]
+                return None
+            self.entries[key] = entry
+            return entry[1]
+
+    def put(self, key, result, ttl):
+        size = result_size(result)
+        with self.lock:
+            self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.entries[key] = (time.time() + ttl, result, size)
+            self.total_bytes += size
+            while (self.max_entries is not None and len(self.entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self.total_bytes -= self.entries.popitem(last=False)[1][2]
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def remove(self, key_prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(key_prefix)]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class SQLiteStorage(object):
+    """
+    Query results in a local SQLite file, shared by processes and kept across runs,
+    at most max_entries of them and at most max_bytes in total. The least recently used result is dropped first.
+    """
+    def __init__(self, path, max_entries=1024, max_bytes=1024 * 1024 * 1024):
+        """
+        :param path: SQLite file
+        :param max_entries: max number of results, None for no limit
+        :param max_bytes: max bytes of all pickled results, None for no limit.
+                          A result larger than that is not cached.
+        :return:
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with self._connect() as conn:
+            conn.execute("create table if not exists query_cache "
+                         "(key text primary key, result blob, expires real, used real)")
+
+    def _connect(self):
+        # a connection per call, so it works in any thread
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("select result, expires from query_cache where key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if row[1] < now:
+                    conn.execute("delete from query_cache where key = ?", (key,))
+                    return None
+                conn.execute("update query_cache set used = ? where key = ?", (now, key))
+            return cPickle.loads(str(row[0]))
+        finally:
+            conn.close()
+
+    def put(self, key, result, ttl):
+        now = time.time()
+        data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("insert or replace into query_cache values (?, ?, ?, ?)",
+                             (key, sqlite3.Binary(data), now + ttl, now))
+                conn.execute("delete from query_cache where expires < ?", (now,))
+                if self.max_entries is not None:
+                    conn.execute("delete from query_cache where key not in "
+                                 "(select key from query_cache order by used desc limit ?)", (self.max_entries,))
+                if self.max_bytes is not None:
+                    self._evict_bytes(conn)
+        finally:
+            conn.close()
+
+    def _evict_bytes(self, conn):
+        total = 0
+        evicted = list()
+        for key, size in conn.execute("select key, length(result) from query_cache order by used desc"):
+            total += size
+            if total > self.max_bytes:
+                evicted.append((key,))
+        conn.executemany("delete from query_cache where key = ?", evicted)
+
+    def remove(self, key_prefix):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("delete from query_cache where substr(key, 1, ?) = ?", (len(key_prefix), key_prefix))
+        finally:
+            conn.close()
+
+    def clear(self):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("delete from query_cache")
+        finally:
+            conn.close()
+
+    def __len__(self):
+        conn = self._connect()
+        try:
+            return conn.execute("select count(*) from query_cache").fetchone()[0]
+        finally:
+            conn.close()
+
+
+class QueryCache(object):
+    """
+    Results of db_pool.query, so the same sql issued by several tables and charts of a report
+    is executed once in ttl seconds.
+
+    A result is stored under the normalized sql and the connection it runs on.
+    Identical queries running at the same time wait for the first one instead of executing again.
+    Rows are shared by all callers, never change them in place.
+    """
+    def __init__(self, storage=None, ttl=300):
+        """
+        :param storage: MemoryStorage (default) or SQLiteStorage
+        :param ttl: seconds a result is used
+        :return:
+        """
+        self.storage = storage if storage is not None else MemoryStorage()
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # key: [lock, number of waiting queries]
+        self.key_locks = dict()
+
+    @staticmethod
+    def _sql_key(sql, identity):
+        normalized_sql = normalize_sql(sql)
+        if isinstance(normalized_sql, unicode):
+            normalized_sql = normalized_sql.encode("utf-8")
+        return hashlib.sha1("%s|%s" % (normalized_sql, identity)).hexdigest()
+
+    @classmethod
+    def key(cls, sql, identity, cursorclass=None, args=None):
+        """
+        :param identity: db_pool.connection_identity(db_info, db_conn)
+        :return: key of the result, starting with the key of the sql
+        """
+        variant = hashlib.sha1("%s|%r" % (getattr(cursorclass, "__name__", None), args)).hexdigest()
+        return "%s.%s" % (cls._sql_key(sql, identity), variant)
+
+    def get_or_execute(self, key, execute):
+        """
+        :param key: key(sql, ...)
+        :param execute: function to get the result when it is not cached
+        :return: the result
+        """
+        result = self.storage.get(key)
+        if result is not None:
+            self._count(True)
+            return result
+
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            with key_lock[0]:
+                # maybe executed by another thread while waiting
+                result = self.storage.get(key)
+                if result is not None:
+                    self._count(True)
+                    return result
+                self._count(False)
+                result = execute()
+                self.storage.put(key, result, self.ttl)
+                return result
+        finally:
+            with self.lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self.key_locks[key]
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def invalidate(self, sql=None, identity=None):
+        """
+        forget results of a sql on a connection, or all results if sql is None,
+        such as after the data is updated
+
+        :param sql: sql to forget
+        :param identity: db_pool.connection_identity(db_info, db_conn)
+        :return:
+        """
+        if sql is None:
+            self.storage.clear()
+        else:
+            self.storage.remove(self._sql_key(sql, identity))
+
+    def stats(self):
+        """
+        :return: dict of hits, misses and number of results, for monitoring
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.storage)}
+
+
+_cache = None
+
+
+def set_cache(cache):
+    """
+    :param cache: QueryCache used by db_pool.query, None to disable cache
+    :return:
+    """
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
@@ -0,0 +1,278 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import json
+from collections import OrderedDict
+
+import db_pool
+import email_util
+import instrument
+import thread_util
+from sqlchart import SQLLineChart, SQLStackChart
+from sqltable import SQLTable, MultiSQLTable
+
+
+class ReportSpecException(Exception):
+    """Exception when a report spec is invalid """
+
+
+class ReportBuildException(Exception):
+    """Exception when widgets of a report fail to build """
+
+
+def load_spec(path):
+    """
+    :param path: report spec file, .json, or .yaml/.yml if PyYAML is installed
+    :return: spec dict
+    """
+    with open(path) as fd:
+        if path.endswith((".yaml", ".yml")):
+            try:
+                import yaml
+            except ImportError:
+                raise ReportSpecException("PyYAML is required to load %s" % (path,))
+            return yaml.safe_load(fd)
+        return json.load(fd, object_pairs_hook=OrderedDict)
+
+
+# name -> function used by complex_cols and col_formats of multi_table widgets
+_functions = dict()
+
+
+def register_function(name, function):
+    """
+    make a function usable by name in complex_cols and col_formats of a report spec
+
+    :param name: name used in the spec, such as "total_run"
+    :param function: same as calculate_function of MultiSQLTable.add_complex_col
+                     or format_function of MultiSQLTable.set_col_format
+    :return:
+    """
+    _functions[name] = function
+
+
+class Report(object):
+    """
+    A report built from a spec instead of code.
+
+    Queries of all widgets run at the same time (at most host_limit at a time on one db host),
+    each chart is rendered as soon as its query is done, and the mail is assembled when all widgets are ready.
+    So the report takes about as long as its slowest widget instead of the sum of all widgets.
+
+    Spec example:
+    {
+        "databases": {"kpi": {"host": "127.0.0.1", "user": "rd", "passwd": "rd", "port": 8989, "charset": "utf8"}},
+        "widgets": [
+            {"name": "table_run", "type": "table", "db": "kpi", "sql": "select ...", "max_rows": 1000},
+            {"name": "chart_run", "type": "line_chart", "db": "kpi", "sql": "select ...", "title": "Day run",
+             "data_start_col": 2, "backend": "matplotlib", "downsample": 800},
+            {"name": "table_all", "type": "multi_table", "headers": ["Date", "Day run", "Week run"],
+             "sources": [{"db": "kpi", "sql": "select ..."}, {"db": "kpi", "sql": "select ..."}]}
+        ],
+        "mail": {
+            "me": "kevin<kevin@qq.com>", "recipients": ["kevin@foxmail.com"], "subject": "Daily report",
+            "template": "report.html",
+            "server": {"mail_server": "smtp.qq.com", "username": "kevin@qq.com", "password": "qq_application_code"}
+        }
+    }
+
+    In the template, a table is {{ table_run }} and a chart is <img src="cid:chart_run">.
+    Without a template, widgets are put into the mail one after another.
+
+    Widget types are table, multi_table, line_chart and stack_chart.
+    Other keys of a widget are passed to SQLTable, MultiSQLTable, SQLLineChart or SQLStackChart,
+    such as custom_order, join_type or data_label.
+
+    complex_cols and col_formats of a multi_table use functions registered by register_function, in order:
+    "complex_cols": [{"col": "Total run", "function": "total_run", "vectorized": false}],
+    "col_formats": [{"col": "Day run", "function": "thousands"}]
+    """
+    widget_types = ("table", "multi_table", "line_chart", "stack_chart")
+
+    def __init__(self, spec, max_workers=8, host_limit=2, chart_limit=2):
+        """
+        :param spec: spec dict, or path of a spec file
+        :param max_workers: max number of queries and charts running at the same time
+        :param host_limit: max number of queries running at the same time on one db host
+        :param chart_limit: max number of charts rendered at the same time
+        :return:
+        """
+        self.spec = load_spec(spec) if isinstance(spec, basestring) else spec
+        self.max_workers = max_workers
+        self.host_limit = host_limit
+        self.chart_limit = chart_limit
+        self._validate()
+
+    def _validate(self):
+        databases = self.spec.get("databases", dict())
+        names = set()
+        for widget in self.spec.get("widgets", list()):
+            name = widget.get("name")
+            if not name:
+                raise ReportSpecException("Widget without name: %s" % (widget,))
+            if name in names:
+                raise ReportSpecException("Widget name %s is used twice" % (name,))
+            names.add(name)
+            if widget.get("type") not in self.widget_types:
+                raise ReportSpecException("Unknown type of widget %s: %s" % (name, widget.get("type")))
+            if widget["type"] == "multi_table":
+                self._validate_functions(widget)
+            sources = widget.get("sources", list()) if widget["type"] == "multi_table" else [widget]
+            for source in sources:
+                if not source.get("sql"):
+                    raise ReportSpecException("No sql in widget %s" % (name,))
+                if source.get("db") not in databases:
+                    raise ReportSpecException("Unknown database of widget %s: %s" % (name, source.get("db")))
+        if "mail" not in self.spec:
+            raise ReportSpecException("No mail in report spec")
+
+    @staticmethod
+    def _validate_functions(widget):
+        for key in ("complex_cols", "col_formats"):
+            for item in widget.get(key, list()):
+                if not isinstance(item, dict) or not item.get("col"):
+                    raise ReportSpecException("No col in %s of widget %s: %s" % (key, widget["name"], item))
+                if item.get("function") not in _functions:
+                    raise ReportSpecException("Unknown function in %s of widget %s: %s" % (
+                        key, widget["name"], item.get("function")))
+
+    def _db_info(self, source):
+        return self.spec["databases"][source["db"]]
+
+    def _host(self, source):
+        db_info = self._db_info(source)
+        return "db:%s:%s" % (db_info.get("host"), db_info.get("port"))
+
+    @staticmethod
+    def _options(widget, *used):
+        return dict((k, v) for k, v in widget.items() if k not in ("name", "type", "db", "sql") + used)
+
+    def build_graph(self):
+        """
+        :return: thread_util.TaskGraph of the report,
+                 task "<name>" gives the html of a table or the image content of a chart
+        """
+        limits = {"chart": self.chart_limit}
+        graph = thread_util.TaskGraph(self.max_workers, limits, default_limit=self.host_limit)
+        for widget in self.spec.get("widgets", list()):
+            getattr(self, "_add_%s" % (widget["type"],))(graph, widget)
+        return graph
+
+    def _traced(self, stage, name, func):
+        def run(results):
+            with instrument.span(stage, widget=name):
+                return func(results)
+        return run
+
+    def _add_table(self, graph, widget):
+        options = self._options(widget, "max_rows")
+
+        def build(results):
+            table = SQLTable(widget["sql"], self._db_info(widget), name=widget["name"], **options)
+            return table.to_html(max_rows=widget.get("max_rows"))
+        graph.add(widget["name"], self._traced("report.table", widget["name"], build), resource=self._host(widget))
+
+    def _add_multi_table(self, graph, widget):
+        source_tasks = list()
+        for index, source in enumerate(widget["sources"]):
+            task_name = "%s.source%d" % (widget["name"], index)
+
+            def query(results, source=source):
+                return db_pool.query(source["sql"], self._db_info(source), None, db_pool.MySQLdb.cursors.DictCursor)
+            graph.add(task_name, self._traced("report.query", widget["name"], query), resource=self._host(source))
+            source_tasks.append(task_name)
+
+        def merge(results):
+            options = self._options(widget, "headers", "sources", "max_rows", "complex_cols", "col_formats")
+            table = MultiSQLTable(widget["headers"], name=widget["name"], **options)
+            # joined in the order of sources, same as add_data_source one by one
+            for task_name in source_tasks:
+                table._merge_data_source(*results[task_name])
+            for item in widget.get("complex_cols", list()):
+                table.add_complex_col(item["col"], _functions[item["function"]], item.get("vectorized", False))
+            for item in widget.get("col_formats", list()):
+                table.set_col_format(item["col"], _functions[item["function"]], item.get("vectorized", False))
+            return table.to_html(max_rows=widget.get("max_rows"))
+        graph.add(widget["name"], self._traced("report.table", widget["name"], merge), source_tasks)
+
+    def _add_chart(self, graph, widget, chart_class):
+        options = self._options(widget, "backend", "downsample")
+        query_task = "%s.query" % (widget["name"],)
+
+        def build(results):
+            chart = chart_class(widget["sql"], self._db_info(widget), **options)
+            if widget.get("backend"):
+                chart.set_backend(widget["backend"])
+            if widget.get("downsample") and hasattr(chart, "set_downsample"):
+                chart.set_downsample(widget["downsample"])
+            return chart
+        graph.add(query_task, self._traced("report.query", widget["name"], build), resource=self._host(widget))
+
+        def render(results):
+            return results[query_task].draw(in_memory=True)
+        graph.add(widget["name"], self._traced("report.chart", widget["name"], render), [query_task],
+                  resource="chart")
+
+    def _add_line_chart(self, graph, widget):
+        self._add_chart(graph, widget, SQLLineChart)
+
+    def _add_stack_chart(self, graph, widget):
+        self._add_chart(graph, widget, SQLStackChart)
+
+    def build(self):
+        """
+        run all queries and charts, then assemble the mail
+
+        :return: NiceReportMail ready to send
+        """
+        with instrument.span("report.build", widget=self.spec["mail"].get("subject")):
+            results = self.build_graph().run()
+
+            failed = [(name, exc_info) for name, (result, exc_info) in results.items() if exc_info]
+            if failed:
+                raise ReportBuildException("Failed widgets: %s" % (
+                    "; ".join(["%s: %s" % (name, exc_info[1]) for name, exc_info in failed]),))
+            return self._assemble(dict((name, result) for name, (result, exc_info) in results.items()))
+
+    def _assemble(self, results):
+        mail_spec = self.spec["mail"]
+        mail = email_util.NiceReportMail(mail_spec.get("me"), mail_spec.get("recipients"), mail_spec.get("subject"),
+                                         None, mail_spec.get("cc_list"), mail_spec.get("bcc_list"))
+        if mail_spec.get("style"):
+            mail.set_style_template(mail_spec["style"])
+
+        contents = OrderedDict()
+        for widget in self.spec.get("widgets", list()):
+            name = widget["name"]
+            if widget["type"] in ("line_chart", "stack_chart"):
+                mail.add_image_bytes(name, results[name])
+                contents[name] = u'<img src="cid:%s">' % (name,)
+            else:
+                contents[name] = results[name]
+
+        if mail_spec.get("template"):
+            template_data = dict(mail_spec.get("data", dict()))
+            template_data.update(contents)
+            mail.set_template_content(mail_spec["template"], template_data)
+        else:
+            mail.set_content(u"<br/>".join(contents.values()))
+        return mail
+
+    def send(self):
+        """
+        build the report and send it by the server in mail spec
+        """
+        mail = self.build()
+        server = self.spec["mail"].get("server", dict())
+        mail.send_mail(server.get("mail_server"), server.get("username"), server.get("password"))
+        return mail
+
+
+def build_report(spec, **kwargs):
+    """
+    :param spec: spec dict, or path of a spec file
+    :param kwargs: max_workers, host_limit or chart_limit of Report
+    :return: NiceReportMail ready to send
+    """
+    return Report(spec, **kwargs).build()
@@ -3,12 +3,19 @@
 __author__ = 'kevinftd'
 
 
-import MySQLdb
-import json
 import os
-import platform
 import hashlib
 import datetime
+import logging
+from collections import OrderedDict
+import chart_backend
+import chart_cache
+import columnar
+import db_pool
+import downsample
+import image_util
+import instrument
+import thread_util
 
 
 class ChartInitException(Exception):
@@ -19,11 +26,38 @@ class NotEnoughColumnsException(Exception):
     """Exception when there are not enough columns for chart """
 
 
+_image_formats = ("jpg", "png", "png8", "webp", "svg")
+# image options of charts created later, see Chart.set_image_options
+_image_options = {"image_format": "jpg", "pixel_ratio": None, "quality": None, "colors": None, "max_bytes": None}
+
+
+def set_image_options(image_format=None, pixel_ratio=None, quality=None, colors=None, max_bytes=None):
+    """
+    change image options for charts created later, same parameters as Chart.set_image_options,
+    such as set_image_options(image_format="png8", pixel_ratio=1.5, max_bytes=150 * 1024)
+    None keeps the current option
+    """
+    if image_format is not None and image_format not in _image_formats:
+        raise ChartInitException("Unknown image format: %s" % (image_format,))
+    options = {"image_format": image_format, "pixel_ratio": pixel_ratio, "quality": quality,
+               "colors": colors, "max_bytes": max_bytes}
+    _image_options.update((k, v) for k, v in options.items() if v is not None)
+
+
 class Chart(object):
     """
     Base class. Use SQLLineChart or SQLStackChart instead of this class.
 
-    Generate chart files with highcharts.js and phantomjs engine
+    Generate chart files with highcharts.js and phantomjs engine,
+    or with another backend set by set_backend() or chart_backend.set_default_backend().
+
+    Each chart starts a new phantomjs process unless the chart server pool
+    is started by chart_server.start_pool(size), then charts are rendered
+    by long-lived phantomjs servers.
+
+    Images are reused from chart_cache when a ChartCache is set by chart_cache.set_cache(cache).
+
+    Images are jpg unless changed by set_image_options() or sqlchart.set_image_options().
     """
     def __init__(self, sql, title):
 
@@ -37,36 +71,136 @@ class Chart(object):
             "series": []
         }
 
-    def __draw__(self):
+        # render parameters of highcharts-convert.js
+        self.scale = 2.5
+        self.width = 800
+        self.image_format = "jpg"
+        self.backend = None
 
-        common_prefix = '%s/%d_%s' % (os.getcwd(), os.getpid(), hashlib.md5(self.sql).hexdigest())
+        self.quality = None
+        self.colors = None
+        self.max_bytes = None
+        self.set_image_options(**_image_options)
 
-        infile_name = '%s.json' % (common_prefix,)
-        outfile_name = '%s.jpg' % (common_prefix,)
-
-        infile = open(infile_name, 'w')
-        infile.write(json.JSONEncoder().encode(self.options))
-        infile.close()
+    def set_image_options(self, image_format=None, pixel_ratio=None, quality=None, colors=None, max_bytes=None):
+        """
+        :param image_format: jpg, png, png8 (png with a palette of at most colors colors), webp or svg.
+                                png8, webp, quality and max_bytes need Pillow.
+        :param pixel_ratio: image pixels per chart pixel, 1 for an image as wide as the chart (800 pixels),
+                                2 for sharp images on high density screens. None keeps 800 pixels.
+        :param quality: quality of jpg and webp, 1 - 100
+        :param colors: max number of colors of png8, default is 256
+        :param max_bytes: size budget of the image, it is made smaller by lower quality,
+                                fewer colors, then fewer pixels until it fits
+        None keeps the current option, which is the one of sqlchart.set_image_options at first
+        :return:
+        """
+        if image_format is not None:
+            if image_format not in _image_formats:
+                raise ChartInitException("Unknown image format: %s" % (image_format,))
+            self.image_format = image_format
+        if pixel_ratio is not None:
+            # phantomjs ignores scale when width is set, width is what decides the pixels
+            self.scale = pixel_ratio
+            self.width = int(self.options["chart"]["width"] * pixel_ratio)
+        if quality is not None:
+            self.quality = quality
+        if colors is not None:
+            self.colors = colors
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+    def _converted(self):
+        """ True if the rendered image is converted by image_util.encode afterwards """
+        if self.image_format == "svg":
+            return False
+        return self.image_format in ("png8", "webp") or \
+            self.quality is not None or self.colors is not None or self.max_bytes is not None
+
+    def _render_format(self):
+        """ format rendered by the backend, a lossless png when the image is converted afterwards """
+        return "png" if self._converted() else self.image_format
+
+    def _encode(self, image):
+        if not self._converted() or not image:
+            return image
+        with instrument.span("chart.encode", widget=self.options["title"]["text"], format=self.image_format) \
+                as encode_span:
+            encode_span.set("rendered_bytes", len(image))
+            return image_util.encode(image, self.image_format, self.quality, self.colors, self.max_bytes)
+
+    def set_backend(self, backend):
+        """
+        :param backend: "phantomjs", "matplotlib" or a ChartBackend object,
+                        None to use chart_backend.get_default_backend()
+        :return:
+        """
+        self.backend = chart_backend.get_backend(backend) if backend is not None else None
 
-        base_path = os.path.dirname(os.path.abspath(__file__))
-        if platform.system() == "Linux":
-            exec_file = "phantomjs"
-        else:
-            exec_file = "phantomjs.exe"
-        command = "{base}/bin/phantomjs/bin/{phantomjs} \
-                    {base}/bin/phantomjs/highcharts-convert.js \
-                    -infile {infile} -outfile {outfile} -scale 2.5 -width 800".format(base=base_path,
-                                                                                      phantomjs=exec_file,
-                                                                                      infile=infile_name,
-                                                                                      outfile=outfile_name)
-        os.system(command)
-        os.remove(infile_name)
+    def __draw__(self, in_memory=False):
+        """
+        :param in_memory: return image content instead of writing an image file
+        :return: image file path in current directory, or image content if in_memory
+        """
+        image = None
+        backend = self.backend or chart_backend.get_default_backend()
+
+        with instrument.span("chart.render", widget=self.options["title"]["text"], backend=backend.name) as render_span:
+            extension = image_util.extension(self.image_format)
+            cache = chart_cache.get_cache()
+            if cache is not None:
+                variant = None
+                if self._converted():
+                    variant = "%s|%s|%s" % (self.quality, self.colors, self.max_bytes)
+                cache_key = cache.key(self.options, self.scale, self.width, self.image_format, backend.name, variant)
+                cached_file = cache.get(cache_key, extension)
+                if cached_file:
+                    with open(cached_file, 'rb') as fd:
+                        image = fd.read()
+                    render_span.set("cache_hits", 1)
+
+            if image is None:
+                image = self._encode(backend.render(self.options, self.scale, self.width, self._render_format()))
+                if cache is not None and image:
+                    cache.put(cache_key, extension, image)
+            render_span.set("bytes", len(image or ""))
+
+        if in_memory:
+            return image
+
+        # id(self) keeps charts of the same SQL apart when drawn in parallel
+        outfile_name = '%s/%d_%d_%s.%s' % (os.getcwd(), os.getpid(), id(self),
+                                           hashlib.md5(self.sql).hexdigest(), image_util.extension(self.image_format))
+        with open(outfile_name, 'wb') as outfile:
+            outfile.write(image)
 
         return outfile_name
 
-    def draw(self):
+    def draw(self, in_memory=False):
         raise NotImplementedError()
 
+    @classmethod
+    def from_query(cls, sql, db_info=None, db_conn=None, **kwargs):
+        """
+        build the chart without waiting for the sql, the sql is executed by db_pool.query_async
+
+        >>>>futures = [SQLLineChart.from_query(sql, db_info, title=title) for sql, title in charts]
+        >>>>charts = thread_util.gather(futures).result()
+
+        :param sql: sql of the chart
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param kwargs: other arguments of SQLLineChart or SQLStackChart
+        :return: thread_util.Future of the chart, it fails with ChartInitException if the sql fails
+        """
+        return db_pool.build_async(cls, ChartInitException, sql, db_info, db_conn, **kwargs)
+
+
+def _format_categories(values):
+    """ x-axis values, dates are shown as month-day """
+    return [v.strftime("%m-%d") if isinstance(v, datetime.date) else v for v in values]
+
+
 class SQLLineChart(Chart):
     """
     line chart with data from SQL
@@ -84,14 +218,23 @@ class SQLLineChart(Chart):
     And if there's multiple product type, there will be multiple lines in the chart.
     """
     def __init__(self, sql, db_info=None, db_conn=None, title=None,
-                 data_start_col=1, line_label_order=None, data_label=False):
+                 data_start_col=1, line_label_order=None, data_label=False, stream=False, batch_size=1000,
+                 watermark_col=None, window=None, result=None):
         """
-        :param db_info: MySQLdb.connect(**server_info)
+        :param db_info: MySQLdb.connect(**server_info), connections are pooled by db_pool
         :param db_conn: MySQLdb.connect
         :param title: chart title
         :param data_start_col: the real data starts from data_start_col
         :param line_label_order: line labels shows in order according to this list
         :param data_label: if show each data value besides the line
+        :param stream: read rows batch by batch by a server-side cursor when drawing,
+                        instead of holding all rows in memory. The chart can be drawn only once.
+        :param batch_size: number of rows fetched at a time in stream mode
+        :param watermark_col: column that grows over time, such as date.
+                                With incremental.set_cache(cache), only rows newer than last time are fetched.
+        :param window: (start, end) of the rolling window, passed to %(start)s and %(end)s in sql,
+                                required with watermark_col
+        :param result: (rows, cursor description) of sql already executed, such as by db_pool.query_async
         :return:
         """
         Chart.__init__(self, sql, title)
@@ -102,32 +245,76 @@ class SQLLineChart(Chart):
             self.options['plotOptions']['line'] = {'marker': {'enabled': True}}
             self.options['plotOptions']['series'] = {'dataLabels': {'enabled': True}}  # if show each data value
 
-        try:
-            if not db_conn:
-                db_conn = MySQLdb.connect(**db_info)
-            db_cursor = db_conn.cursor()
-            db_cursor.execute(sql)
-            db_conn.commit()
+        # no downsampling unless set_downsample() is called
+        self.downsample_points = None
+        self.downsample_method = "lttb"
 
-            self.data = db_cursor.fetchall()
-            self.theader_list = [column[0] for column in db_cursor.description]
-            self.col_description = db_cursor.description
-            self.data_start_col = data_start_col if data_start_col >=1 else 1
-            self.line_label_order = line_label_order
-        except Exception as e:
-            raise ChartInitException(e.message)
+        with instrument.span("chart.build", widget=title):
+            try:
+                # without db_conn, a pooled connection of db_info is used
+                self.data, description = db_pool.fetch(sql, db_info, db_conn, stream, batch_size,
+                                                       watermark_col, window, result)
+                self.theader_list = [column[0] for column in description]
+                self.col_description = description
+                self.data_start_col = data_start_col if data_start_col >=1 else 1
+                self.line_label_order = line_label_order
+            except Exception as e:
+                raise ChartInitException(e.message)
 
 
     def set_line_label_order(self, value):
         if isinstance(value, list):
             self.line_label_order = value
 
-    def draw(self):
+    def set_downsample(self, points=None, method="lttb"):
+        """
+        draw at most about points values for each line, for long time series such as minute-level data,
+        since a chart cannot show more points than pixels anyway
+
+        :param points: number of points to keep for each line, None for the chart width
+        :param method: "lttb" keeps the shape of the line, "min_max" keeps the min and max of each bucket
+        :return:
+        """
+        if method not in ("lttb", "min_max"):
+            raise downsample.DownsampleException("Unknown downsampling method: %s" % (method,))
+        self.downsample_points = points or self.width
+        self.downsample_method = method
+
+    def _downsample(self):
+        categories = self.options["xAxis"]["categories"]
+        series = self.options["series"]
+        if len(categories) <= self.downsample_points:
+            return
+        if any([len(item["data"]) != len(categories) for item in series]):
+            # values of a line are not one for each x-axis value, cannot drop the same points of all lines
+            logging.warning("lines of chart %s have different lengths, not downsampled" % (self.options["title"]["text"],))
+            return
+
+        indexes = downsample.downsample_indexes([item["data"] for item in series],
+                                                self.downsample_points, self.downsample_method)
+        self.options["xAxis"]["categories"] = columnar.take(categories, indexes)
+        for item in series:
+            item["data"] = columnar.take(item["data"], indexes)
+
+    def draw(self, in_memory=False):
+        """
+        :param in_memory: return image content instead of writing an image file
+        :return: image file path, or image content if in_memory
+        """
         if len(self.theader_list) <= 1:
             raise NotEnoughColumnsException("Num of cols "
                                             "fetched by sql is less than 1. "
                                             "Cannot draw chart")
 
+        with instrument.span("chart.options", widget=self.options["title"]["text"]) as options_span:
+            self._build_options()
+            if self.downsample_points:
+                self._downsample()
+            options_span.set("points", sum([len(item["data"]) for item in self.options["series"]]))
+
+        return self.__draw__(in_memory)
+
+    def _build_options(self):
         """
         In highcharts, xAxis has four optional types
         linear, logarithmic, datetime and category
@@ -138,40 +325,39 @@ class SQLLineChart(Chart):
         Ref: http://api.highcharts.com/highcharts#xAxis.type
         """
 
+        # rows are read only once, so self.data can also be a stream of rows.
+        # values are kept column by column, then each series is a whole column or a slice of it
+        columns = columnar.to_columns(self.data, len(self.theader_list))
+        data_cols = range(self.data_start_col, len(self.theader_list))
         if self.data_start_col == 1: # line data starts from column-1, column-0 is x-axis data such as datetime
 
             """
-            draw a line for each column， so extract value from self.data by columns
+            draw a line for each column
             """
-            # y-axis values
-            for i in range(self.data_start_col, len(self.theader_list)):
-                name = self.theader_list[i]
-                values = [r[i] for r in self.data]
-                self.options["series"].append({"name": name, "data": values})
-
             # x-axis values
-            self.options["xAxis"]["categories"] = \
-                [r[0].strftime("%m-%d") if isinstance(r[0], datetime.date) else r[0]
-                 for r in self.data]
+            self.options["xAxis"]["categories"] = _format_categories(columns[0])
+            # y-axis values
+            for i in data_cols:
+                self.options["series"].append({"name": self.theader_list[i], "data": columns[i]})
         else:
             # column-0 is x-axis data such as datetime，
             # column-1~column-data_start_col is group info that
             # divides one column into multiple lines
             """
-            extract value from self.data by columns
+            group rows by group info, each group has a line for each data column
             """
-            names = set()
-            values = dict()
-            for i in range(self.data_start_col, len(self.theader_list)):
-                for r in self.data:
-                    name = self._generate_series_name(r, i) # line name is composed by group info and column name
-                    names.add(name)
-                    if name not in values:
-                        values[name] = list()
-                    values[name].append(r[i])
+            values = OrderedDict()
+            groups = columnar.group_columns(columns, range(1, self.data_start_col), data_cols)
+            for group_key, group_columns in groups.iteritems():
+                for i, group_values in zip(data_cols, group_columns):
+                    # line name is composed by group info and column name, once for each group
+                    values[self._generate_series_name(group_key, i)] = group_values
+
+            # x-axis
+            self.options["xAxis"]["categories"] = _format_categories(columnar.unique(columns[0]))
 
             if not self.line_label_order:
-                show_line_names = names
+                show_line_names = values.keys()
             else:
                 show_line_names = self.line_label_order
 
@@ -179,21 +365,11 @@ class SQLLineChart(Chart):
             for name in show_line_names:
                 self.options["series"].append({"name": name, "data": values.get(name, list())})
 
-            # x-axis
-            self.options["xAxis"]["categories"] = list()
-            category_set = set()
-            for r in self.data:
-                if r[0] not in category_set:
-                    category_set.add(r[0])
-                    self.options["xAxis"]["categories"].append(r[0].strftime("%m-%d") if isinstance(r[0], datetime.date) else r[0])
-
-        return self.__draw__()
-
-    def _generate_series_name(self, row, current_col_index):
+    def _generate_series_name(self, group_key, current_col_index):
         """ line name is composed by
-        column-1~column-data_start_col value and current column name
+        column-1~column-data_start_col value (group_key) and current column name
         """
-        name = " ".join([row[col] for col in range(1, self.data_start_col)])
+        name = " ".join(group_key)
 
         if len(self.theader_list)-self.data_start_col >= 2:
             # if there is many data columns, append current data column name
@@ -205,11 +381,20 @@ class SQLStackChart(Chart):
     """
     stack chart with data from SQL
     """
-    def __init__(self, sql, db_info=None, db_conn=None, title=None):
+    def __init__(self, sql, db_info=None, db_conn=None, title=None, stream=False, batch_size=1000,
+                 watermark_col=None, window=None, result=None):
         """
-        :param db_info: MySQLdb.connect(**server_info)
+        :param db_info: MySQLdb.connect(**server_info), connections are pooled by db_pool
         :param db_conn: MySQLdb.connect
         :param title: chart title
+        :param stream: read rows batch by batch by a server-side cursor when drawing,
+                        instead of holding all rows in memory. The chart can be drawn only once.
+        :param batch_size: number of rows fetched at a time in stream mode
+        :param watermark_col: column that grows over time, such as date.
+                                With incremental.set_cache(cache), only rows newer than last time are fetched.
+        :param window: (start, end) of the rolling window, passed to %(start)s and %(end)s in sql,
+                                required with watermark_col
+        :param result: (rows, cursor description) of sql already executed, such as by db_pool.query_async
         :return:
         """
         Chart.__init__(self, sql, title)
@@ -219,32 +404,59 @@ class SQLStackChart(Chart):
 
         # prefer to use following colors first
         self.default_colors = ['#4472A5', '#A94642', '#87A34E', '#70588D', '#4097AD', '#D9833C']
-        try:
-            if not db_conn:
-                db_conn = MySQLdb.connect(**db_info)
-            db_cursor = db_conn.cursor()
-            db_cursor.execute(sql)
-            db_conn.commit()
-
-            self.data = db_cursor.fetchall()
-            self.theader_list = [column[0] for column in db_cursor.description]
-            self.col_description = db_cursor.description
-
-            self.options['xAxis']['categories'] = [r[0] for r in self.data]
-        except Exception as e:
-            raise ChartInitException(e.message)
-
-    def draw(self):
-        for i in range(1, len(self.theader_list)):
-            values = list()
-            for r in self.data:
-                values.append(r[i])
-            item = {"name": self.theader_list[i], "data": values}
-            if i <= len(self.default_colors):
-                item["color"] = self.default_colors[i-1]
-            self.options["series"].append(item)
-
-        return self.__draw__()
+        with instrument.span("chart.build", widget=title):
+            try:
+                # without db_conn, a pooled connection of db_info is used
+                self.data, description = db_pool.fetch(sql, db_info, db_conn, stream, batch_size,
+                                                       watermark_col, window, result)
+                self.theader_list = [column[0] for column in description]
+                self.col_description = description
+            except Exception as e:
+                raise ChartInitException(e.message)
+
+    def draw(self, in_memory=False):
+        """
+        :param in_memory: return image content instead of writing an image file
+        :return: image file path, or image content if in_memory
+        """
+        with instrument.span("chart.options", widget=self.options["title"]["text"]) as options_span:
+            # rows are read only once, so self.data can also be a stream of rows
+            columns = columnar.to_columns(self.data, len(self.theader_list))
+            self.options['xAxis']['categories'] = columns[0]
+
+            for i in range(1, len(self.theader_list)):
+                item = {"name": self.theader_list[i], "data": columns[i]}
+                if i <= len(self.default_colors):
+                    item["color"] = self.default_colors[i-1]
+                self.options["series"].append(item)
+            options_span.set("points", len(columns[0]) * (len(self.theader_list) - 1))
+
+        return self.__draw__(in_memory)
+
+
+def render_charts(charts, max_workers=4, in_memory=False):
+    """
+    draw many charts in parallel
+
+    Each chart is drawn by chart.draw() in one of max_workers threads,
+    so the phantomjs processes (or chart servers) work at the same time.
+    A failed chart does not stop the others.
+
+    :param charts: list of SQLLineChart or SQLStackChart
+    :param max_workers: max number of charts drawn at the same time
+    :param in_memory: get image content instead of image files
+    :return: OrderedDict in the order of charts, chart -> image file (or content),
+             or chart -> exception if the chart failed to draw
+    """
+    results = OrderedDict()
+    drawn = thread_util.map_in_threads(lambda c: c.draw(in_memory), charts, max_workers)
+    for chart, (chart_file, exc_info) in zip(charts, drawn):
+        if exc_info:
+            logging.error("failed to draw chart: %s" % (chart.options["title"]["text"],), exc_info=exc_info)
+            results[chart] = exc_info[1]
+        else:
+            results[chart] = chart_file
+    return results
 
 
 if __name__ == "__main__":
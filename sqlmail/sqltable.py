@@ -2,64 +2,235 @@
 # coding:utf-8
 __author__ = 'kevinftd'
 
+import codecs
+import csv
 import MySQLdb
-import os
+import sys
+from itertools import chain, imap, islice, izip
+from operator import itemgetter
+import threading
+import time
 import email_util
+import columnar
+import db_pool
+import instrument
+import template_util
+import thread_util
 
 
 class Table(object):
-    pass
+    """
+    Base class of tables rendered by the package template sql_table.html.
+
+    Rows are passed to the template one by one, so rendering never builds another list of all rows,
+    and write_html() writes the html piece by piece instead of building one string.
+    """
+    # name of the table in traces, such as the widget name of a report
+    name = None
+
+    def _iter_rows(self):
+        raise NotImplementedError()
+
+    def _widget(self):
+        return self.name or self.__class__.__name__
+
+    def _generate_html(self, max_rows=None, csv_file=None):
+        rows = self._iter_rows()
+        self.more_rows = 0
+        if max_rows is not None:
+            rows, self.more_rows = self._limit_rows(rows, max_rows, csv_file)
+
+        template = template_util.get_package_template('sql_table.html')
+        return template.generate({"header": self.theader_list, "body": rows, "more_rows": self.more_rows})
+
+    def _limit_rows(self, rows, max_rows, csv_file):
+        rows = iter(rows)
+        shown = list(islice(rows, max_rows))
+        next_row = next(rows, None)
+        if next_row is None:
+            return shown, 0
+        rest = chain([next_row], rows)
+        if csv_file is None:
+            return shown, sum(1 for r in rest)
+        return shown, write_csv(csv_file, self.theader_list, chain(shown, rest)) - len(shown)
+
+    def to_html(self, max_rows=None, csv_file=None):
+        """
+        :param max_rows: show at most max_rows rows, followed by a row telling how many more rows there are
+        :param csv_file: file-like object, all rows are written into it as csv if there are more than max_rows,
+                        such as a tempfile to be attached by email.add_attachment("table.csv", csv_file)
+        :return: html, self.more_rows is the number of rows not shown
+        """
+        with instrument.span("table.to_html", widget=self._widget()) as html_span:
+            html = u"".join(self._generate_html(max_rows, csv_file))
+            html_span.set("bytes", len(html))
+        return html
+
+    def write_html(self, fd, max_rows=None, csv_file=None):
+        """
+        same as to_html, but write the utf-8 encoded html into fd piece by piece
+
+        :param fd: file-like object
+        :return:
+        """
+        with instrument.span("table.to_html", widget=self._widget()) as html_span:
+            for piece in self._generate_html(max_rows, csv_file):
+                piece = piece.encode("utf-8")
+                fd.write(piece)
+                html_span.add("bytes", len(piece))
+
+    def to_csv(self, fd):
+        """
+        write all rows into fd as csv
+
+        :param fd: file-like object
+        :return: number of rows
+        """
+        return write_csv(fd, self.theader_list, self._iter_rows())
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+def write_csv(fd, header, rows):
+    """
+    write rows as utf-8 csv, with a BOM so that excel shows chinese correctly
+
+    :param fd: file-like object
+    :param header: column names
+    :param rows: list or iterator of rows
+    :return: number of rows
+    """
+    fd.write(codecs.BOM_UTF8)
+    writer = csv.writer(fd)
+    writer.writerow([_csv_value(name) for name in header])
+    count = 0
+    for r in rows:
+        writer.writerow([_csv_value(value) for value in r])
+        count += 1
+    return count
 
 
 class TableInitException(Exception):
     """Exception when init table using SQL """
 
 
+def reorder_rows(rows, order, order_col=0, duplicates=False, keep_rest=False):
+    """
+    put rows in the order of values in column order_col
+
+    rows are indexed by the column value once, so it takes O(rows + order) time
+
+    :param rows: list of rows
+    :param order: list of column values, or list of value lists if order_col is a list
+    :param order_col: column index, or a list of column indexes
+    :param duplicates: take all rows of a value, otherwise only the first one
+    :param keep_rest: append rows whose value is not in order, in their original order
+    :return: list of rows
+    """
+    multi_col = isinstance(order_col, (list, tuple))
+    if multi_col:
+        row_key = lambda r: tuple(r[col] for col in order_col)
+        order_key = lambda value: tuple(unicode(v) for v in value)
+    else:
+        row_key = lambda r: r[order_col]
+        order_key = unicode
+
+    index = dict()
+    for position, r in enumerate(rows):
+        index.setdefault(row_key(r), list()).append(position)
+
+    ordered = list()
+    used = set()
+    for value in order:
+        positions = index.get(order_key(value))
+        if not positions:
+            continue
+        if not duplicates:
+            positions = positions[:1]
+        ordered.extend(rows[p] for p in positions)
+        used.update(positions)
+
+    if keep_rest:
+        ordered.extend(r for position, r in enumerate(rows) if position not in used)
+    return ordered
+
+
 class SQLTable(Table):
     """" generate HTML table with data retrieved by SQL
 
     each row in the SQL result will be one single row in the HTML table
     """
-    def __init__(self, sql, db_info=None, db_conn=None, custom_order=None, custom_order_col=0):
+    def __init__(self, sql, db_info=None, db_conn=None, custom_order=None, custom_order_col=0,
+                 custom_order_duplicates=False, custom_order_keep_rest=False, stream=False, batch_size=1000,
+                 watermark_col=None, window=None, result=None, name=None):
         """
         :param sql: note to use `date_format` to format date type and use `format(int, n)` to format INTEGER or FLOAT
-        :param db_info: MySQLdb.connect(**db_info)
+        :param db_info: MySQLdb.connect(**db_info), connections are pooled by db_pool
         :param db_conn: MySQLdb.connect
         :param custom_order: To put the rows in some specific order,
                                 provide a list that contains values in the FIRST column.
                                 The rows will display in order according to this list.
-        :param custom_order_col: default is 0 for the FIRST column, change it to order by other column
+        :param custom_order_col: default is 0 for the FIRST column, change it to order by other column.
+                                A list of columns orders by multiple columns,
+                                then each item of custom_order is a list of values of these columns.
+        :param custom_order_duplicates: show all rows of a value in custom_order, not only the first one
+        :param custom_order_keep_rest: show rows not in custom_order at the end, instead of dropping them
+        :param stream: read rows batch by batch by a server-side cursor when rendering,
+                        instead of holding all rows in memory. Rows can be rendered only once.
+                        custom_order still needs all rows.
+        :param batch_size: number of rows fetched at a time in stream mode
+        :param watermark_col: column that grows over time, such as date.
+                                With incremental.set_cache(cache), only rows newer than last time are fetched.
+        :param window: (start, end) of the rolling window, passed to %(start)s and %(end)s in sql,
+                                required with watermark_col
+        :param result: (rows, cursor description) of sql already executed, such as by db_pool.query_async
+        :param name: name of the table in traces, such as "table_run", default is the class name
         :return:
         """
-        try:
-            if not db_conn:
-                db_conn = MySQLdb.connect(**db_info)
-            db_cursor = db_conn.cursor()
-            db_cursor.execute(sql)
-            db_conn.commit()
-
-            self.data = db_cursor.fetchall()
-
-            self.theader_list = [column[0].decode("utf-8") for column in db_cursor.description]
-
-            if custom_order:
-                order_data = list()
-                for i in range(len(custom_order)):
-                    for r in self.data:
-                        if r[custom_order_col] == unicode(custom_order[i]):
-                            order_data.append(r)
-                            break
-                self.data = order_data
-        except Exception as e:
-            raise TableInitException(e.message)
-
-    def to_html(self):
-        from jinja2 import Environment, FileSystemLoader
-        env = Environment(loader=FileSystemLoader('%s/templates' % (os.path.dirname(os.path.abspath(__file__)),)))
-        template = env.get_template('sql_table.html')
-        html = template.render({"header": self.theader_list, "body": self.data})
+        self.name = name
+        with instrument.span("table.build", widget=self._widget()) as build_span:
+            try:
+                # without db_conn, a pooled connection of db_info is used
+                self.data, description = db_pool.fetch(sql, db_info, db_conn, stream, batch_size,
+                                                       watermark_col, window, result)
+
+                self.theader_list = [column[0].decode("utf-8") for column in description]
+
+                if custom_order:
+                    if not isinstance(self.data, (list, tuple)):
+                        # all rows of a stream are read to reorder them
+                        self.data = list(self.data)
+                    self.data = reorder_rows(self.data, custom_order, custom_order_col,
+                                             custom_order_duplicates, custom_order_keep_rest)
+                if isinstance(self.data, (list, tuple)):
+                    build_span.set("rows", len(self.data))
+            except Exception as e:
+                raise TableInitException(e.message)
+
+    def _iter_rows(self):
+        return self.data
+
+    @classmethod
+    def from_query(cls, sql, db_info=None, db_conn=None, **kwargs):
+        """
+        build the table without waiting for the sql, the sql is executed by db_pool.query_async
 
-        return html
+        >>>>futures = [SQLTable.from_query(sql, db_info) for sql in sqls]
+        >>>>tables = thread_util.gather(futures).result()
+
+        :param sql: sql of the table
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param kwargs: other arguments of SQLTable
+        :return: thread_util.Future of SQLTable, it fails with TableInitException if the sql fails
+        """
+        return db_pool.build_async(cls, TableInitException, sql, db_info, db_conn, **kwargs)
 
 
 class ColNameConflictException(Exception):
@@ -69,6 +240,29 @@ class TableHeaderNullException(Exception):
     """Exception that table header should not be null """
 
 
+class DataSourceTimeoutException(Exception):
+    """Exception that a data source sql is not finished in time """
+
+
+class _DataSource(object):
+    """ a sql registered by MultiSQLTable.register_data_source """
+    def __init__(self, sql, db_info, db_conn, timeout):
+        self.sql = sql
+        self.db_info = db_info
+        self.db_conn = db_conn
+        self.timeout = timeout
+
+        self.start_time = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+# value of a column in a row the column's data source does not have
+_MISSING = object()
+
+
 class MultiSQLTable(Table):
     """
     Use this class when single SQL cannot meet your demand.
@@ -84,73 +278,300 @@ class MultiSQLTable(Table):
     day, value1, value2
     xxx, xxxxxx, xxxxx
     zzz, zzzzzz, zzzzz
+
+    join_type decides which rows are shown:
+    left (default) rows of the first data source,
+    inner rows found in all data sources,
+    outer rows found in any data source, in the order they first appear.
+
+    Values are kept column by column, one list for each column, a row is a position in these lists.
     """
-    def __init__(self, table_headers, sql_data_start=1):
+    def __init__(self, table_headers, sql_data_start=1, join_type="left", name=None):
+        """
+        :param table_headers: headers of all columns shown, in order
+        :param sql_data_start: columns before it are the join keys of each data source
+        :param join_type: left, inner or outer
+        :param name: name of the table in traces, such as "table_all", default is the class name
+        :return:
+        """
 
         if not table_headers:
             raise TableHeaderNullException("Table header is required as an argument.")
+        if join_type not in ("left", "inner", "outer"):
+            raise TableInitException("Unknown join type: %s" % (join_type,))
 
         self.data_cols_start = sql_data_start
-        self.data_dict = dict()
+        self.join_type = join_type
+        self.name = name
         self.data_col_names = set()
-        self.line_key_order = list()
         self.theader_list = table_headers
+        # col name -> (format function, vectorized)
         self.format_functions = dict()
+        # data sources registered by register_data_source
+        self.pending_sources = list()
+
+        # join key tuple -> row position
+        self.row_index = dict()
+        # col name -> list of values, _MISSING where the data source of the col has no such row
+        self.columns = dict()
+        # number of data sources each row is found in, for inner join
+        self.match_counts = list()
+        self.source_count = 0
+
+    def add_data_source(self, sql, db_info=None, db_conn=None, stream=False, batch_size=1000, watermark_col=None,
+                        window=None):
+        """
+        :param sql: sql of the data source
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param stream: join rows batch by batch read by a server-side cursor,
+                        instead of fetching all rows first
+        :param batch_size: number of rows fetched at a time in stream mode
+        :param watermark_col: column that grows over time, such as date.
+                                With incremental.set_cache(cache), only rows newer than last time are fetched.
+        :param window: (start, end) of the rolling window, passed to %(start)s and %(end)s in sql,
+                                required with watermark_col
+        :return:
+        """
+        with instrument.span("table.build", widget=self._widget()):
+            # without db_conn, a pooled connection of db_info is used
+            results, description = db_pool.fetch(sql, db_info, db_conn, stream, batch_size, watermark_col, window,
+                                                 dict_rows=True)
+            self._merge_data_source(results, description)
+
+    def register_data_source(self, sql, db_info=None, db_conn=None, timeout=None):
+        """
+        same as add_data_source, but the sql is executed later by execute_data_sources,
+        together with other registered data sources
+
+        :param sql: sql of the data source
+        :param db_info: MySQLdb.connect(**db_info)
+        :param db_conn: MySQLdb.connect
+        :param timeout: seconds to wait for this sql, None to wait forever
+        :return:
+        """
+        self.pending_sources.append(_DataSource(sql, db_info, db_conn, timeout))
 
-    def add_data_source(self, sql, db_info=None, db_conn=None):
+    def execute_data_sources(self, max_workers=4):
+        """
+        execute all registered data sources at the same time, then join them in the registration order,
+        so the result is the same as calling add_data_source one by one
 
-        if not db_conn:
-            db_conn = MySQLdb.connect(**db_info)
-        db_cursor = db_conn.cursor(cursorclass=MySQLdb.cursors.DictCursor)
-        db_cursor.execute(sql)
-        db_conn.commit()
+        Note that a timed out sql keeps running in the background until the db server returns,
+        set read_timeout in db_info to stop it on the db side.
 
-        results = db_cursor.fetchall()
-        results_name = [column[0] for column in db_cursor.description]
+        :param max_workers: max number of sql executed at the same time
+        :return:
+        """
+        sources = self.pending_sources
+        self.pending_sources = list()
+
+        slots = threading.Semaphore(max(1, max_workers))
+        # one connection cannot execute two sql at the same time
+        conn_locks = dict((id(s.db_conn), threading.Lock()) for s in sources if s.db_conn)
+
+        def execute(source):
+            with slots, instrument.span("table.build", widget=self._widget()):
+                source.start_time = time.time()
+                source.started.set()
+                try:
+                    if source.db_conn:
+                        with conn_locks[id(source.db_conn)]:
+                            source.result = db_pool.query(source.sql, None, source.db_conn,
+                                                          MySQLdb.cursors.DictCursor)
+                    else:
+                        source.result = db_pool.query(source.sql, source.db_info, None, MySQLdb.cursors.DictCursor)
+                except Exception:
+                    source.exc_info = sys.exc_info()
+                finally:
+                    source.finished.set()
+
+        for source in sources:
+            thread = threading.Thread(target=execute, args=(source,))
+            thread.daemon = True
+            thread.start()
+
+        for source in sources:
+            source.started.wait()
+            if source.timeout is None:
+                source.finished.wait()
+            else:
+                source.finished.wait(max(0, source.timeout - (time.time() - source.start_time)))
+            if not source.finished.is_set():
+                raise DataSourceTimeoutException("Data source timed out after %s seconds: %s" % (source.timeout,
+                                                                                                  source.sql))
+            if source.exc_info:
+                raise source.exc_info[0], source.exc_info[1], source.exc_info[2]
+
+        for source in sources:
+            self._merge_data_source(*source.result)
+
+    @classmethod
+    def from_queries(cls, table_headers, sources, sql_data_start=1, join_type="left", name=None):
+        """
+        build the table without waiting for the sql of its data sources,
+        all sql are executed at the same time by db_pool.query_async, then joined in the order of sources
+
+        >>>>future = MultiSQLTable.from_queries(headers, [(sql1, db_info), (sql2, db_info)])
+        >>>>table = future.result()
+        >>>>table.add_complex_col(...)
+
+        :param table_headers: same as MultiSQLTable
+        :param sources: list of (sql, db_info) or (sql, db_info, db_conn)
+        :param sql_data_start: same as MultiSQLTable
+        :param join_type: same as MultiSQLTable
+        :param name: same as MultiSQLTable
+        :return: thread_util.Future of MultiSQLTable
+        """
+        table = cls(table_headers, sql_data_start, join_type, name)
+        futures = list()
+        for source in sources:
+            sql, db_info, db_conn = (tuple(source) + (None,))[:3]
+            futures.append(db_pool.query_async(sql, db_info, db_conn, MySQLdb.cursors.DictCursor))
+
+        def merge(results):
+            for rows, description in results:
+                table._merge_data_source(rows, description)
+            return table
+        return thread_util.gather(futures).then(merge)
+
+    def _merge_data_source(self, results, description):
+        with instrument.span("table.merge", widget=self._widget()) as merge_span:
+            self._join_data_source(results, description)
+            merge_span.set("rows", len(self.match_counts))
+
+    def _join_data_source(self, results, description):
+        results_name = [column[0] for column in description]
         conflict_col_names = self.data_col_names & set(results_name[self.data_cols_start:])
         if len(conflict_col_names) > 0:
             raise ColNameConflictException("Conflict: %s already in data set" % (
                 ",".join(list([n.decode("utf-8") for n in conflict_col_names]))))
-
         self.data_col_names.update(set(results_name[self.data_cols_start:]))
-        if len(self.data_dict) == 0:
-            first_data_source = True
-        else:
-            first_data_source = False
-
-        for r in results:
-            line_name = ",".join([r[results_name[i]] for i in range(self.data_cols_start)])
-            if first_data_source:
-                self.line_key_order.append(line_name)
-            if line_name not in self.data_dict:
-                self.data_dict[line_name] = dict()
-            for col in results_name:
-                self.data_dict[line_name][col.decode("utf-8")] = r[col]
-
-    def add_complex_col(self, col_key, calculate_function):
-        for line in self.data_dict:
-            row = self.data_dict[line]
-            row[col_key] = calculate_function(row)
 
-    def set_col_format(self, col_key, format_function):
-        self.format_functions[col_key] = format_function
+        # dict rows into value tuples, then into columns batch by batch
+        if len(results_name) == 1:
+            row_values = lambda r: (r[results_name[0]],)
+        else:
+            row_values = itemgetter(*results_name)
+        source_columns = columnar.to_columns(imap(row_values, results), len(results_name))
+
+        keys = zip(*source_columns[:self.data_cols_start])
+        positions = self._join_positions(keys)
+        row_count = len(self.match_counts)
+
+        for name, values in zip(results_name, source_columns):
+            name = name.decode("utf-8")
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = [_MISSING] * row_count
+            else:
+                column.extend([_MISSING] * (row_count - len(column)))
+
+            if positions == range(len(values)) and len(values) == row_count:
+                # rows of the first data source, no need to move values
+                self.columns[name] = values
+                continue
+            for position, value in zip(positions, values):
+                if position is not None:
+                    column[position] = value
+
+        for position in set(positions):
+            if position is not None:
+                self.match_counts[position] += 1
+        self.source_count += 1
+
+    def _join_positions(self, keys):
+        """
+        :param keys: join key of each row of a data source
+        :return: row position of each key, None if the row is not joined
+        """
+        row_index = self.row_index
+        positions = map(row_index.get, keys)
+        if self.source_count == 0 or self.join_type == "outer":
+            # rows of the first data source, and new rows of outer join, get new positions
+            for i in [i for i, position in enumerate(positions) if position is None]:
+                position = row_index.get(keys[i])
+                if position is None:
+                    position = row_index[keys[i]] = len(self.match_counts)
+                    self.match_counts.append(0)
+                positions[i] = position
+        return positions
+
+    def _shown_positions(self):
+        if self.join_type == "inner":
+            return [p for p, count in enumerate(self.match_counts) if count == self.source_count]
+        return range(len(self.match_counts))
+
+    def add_complex_col(self, col_key, calculate_function, vectorized=False):
+        """
+        :param col_key: name of the new column
+        :param calculate_function: function of a row dict (col name -> value) returning the value,
+                                    or if vectorized, function of a column dict (col name -> list of values)
+                                    returning the list of values, which is much faster for large tables.
+                                    A value missing because a data source has no such row is absent
+                                    from the row dict, and None in the lists of the column dict.
+        :param vectorized: see calculate_function, the column dict is a copy of the table columns
+        :return:
+        """
+        row_count = len(self.match_counts)
+        for column in self.columns.values():
+            column.extend([_MISSING] * (row_count - len(column)))
+
+        if vectorized:
+            columns = dict((name, [None if value is _MISSING else value for value in column])
+                           for name, column in self.columns.items())
+            values = list(calculate_function(columns))
+            if len(values) != row_count:
+                raise TableInitException("%s values are calculated for %s rows" % (len(values), row_count))
+        else:
+            names = self.columns.keys()
+            values = list()
+            for row_values in zip(*[self.columns[name] for name in names]):
+                row = dict((name, value) for name, value in zip(names, row_values) if value is not _MISSING)
+                values.append(calculate_function(row))
+        self.columns[col_key] = values
+
+    def set_col_format(self, col_key, format_function, vectorized=False):
+        """
+        :param col_key: column name
+        :param format_function: function of a value returning the shown value,
+                                or if vectorized, function of the list of values returning the list of shown values
+        :param vectorized: see format_function
+        :return:
+        """
+        self.format_functions[col_key] = (format_function, vectorized)
 
     def _generate_rows(self):
-        rows = list()
-        for line_name in self.line_key_order:
-            row_data = list()
-            for col in self.theader_list:
-                row_data.append(self.format_functions.get(col, lambda x: x)(self.data_dict[line_name].get(col, "")))
-            rows.append(row_data)
-        return rows
-
-    def to_html(self):
-        from jinja2 import Environment, FileSystemLoader
-        env = Environment(loader=FileSystemLoader('%s/templates' % (os.path.dirname(os.path.abspath(__file__)),)))
-        template = env.get_template('sql_table.html')
-        html = template.render({"header": self.theader_list, "body": self._generate_rows()})
-
-        return html
+        return zip(*self._shown_columns())
+
+    def _shown_columns(self):
+        positions = self._shown_positions()
+        shown_columns = list()
+        for col in self.theader_list:
+            column = self.columns.get(col)
+            if column is None:
+                shown_columns.append([""] * len(positions))
+                continue
+
+            values = columnar.take(column + [_MISSING] * (len(self.match_counts) - len(column)), positions)
+            format_function, vectorized = self.format_functions.get(col, (None, False))
+            present = [i for i, value in enumerate(values) if value is not _MISSING]
+            if format_function is not None:
+                # missing values are shown as empty, never formatted
+                present_values = columnar.take(values, present)
+                if vectorized:
+                    formatted = format_function(present_values)
+                else:
+                    formatted = map(format_function, present_values)
+                for i, value in zip(present, formatted):
+                    values[i] = value
+            if len(present) < len(values):
+                values = [value if value is not _MISSING else "" for value in values]
+            shown_columns.append(values)
+        return shown_columns
+
+    def _iter_rows(self):
+        return izip(*self._shown_columns())
 
 
 if __name__ == "__main__":
@@ -188,8 +609,10 @@ if __name__ == "__main__":
             where version = 'total' and stat_date >= 20150520 and stat_date <= 20150526"
 
     table = MultiSQLTable([u'Date', u'Day run', u'Week run', u'Total run'])
-    table.add_data_source(sql1, db_info=db_info1)
-    table.add_data_source(sql2, db_info=db_info2)
+    # execute sql1 and sql2 at the same time
+    table.register_data_source(sql1, db_info=db_info1, timeout=60)
+    table.register_data_source(sql2, db_info=db_info2, timeout=60)
+    table.execute_data_sources()
 
     table.add_complex_col(u'Total run', lambda row: row[u'Day run'] + row[u'Week run'])
     table.set_col_format(u'Day run', lambda x: format(float(x)/100, ','))
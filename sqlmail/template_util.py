@@ -0,0 +1,77 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import os
+import threading
+
+
+PACKAGE_TEMPLATE_DIR = '%s/templates' % (os.path.dirname(os.path.abspath(__file__)),)
+
+_environments = dict()
+_lock = threading.Lock()
+_debug = False
+# None for the default jinja2 cache directory in the temp dir, False to disable
+_bytecode_cache_dir = None
+
+
+def set_debug(debug):
+    """
+    :param debug: reload templates when the files change, only useful when editing templates
+    :return:
+    """
+    global _debug
+    _debug = debug
+    with _lock:
+        for env in _environments.values():
+            env.auto_reload = debug
+
+
+def set_bytecode_cache_dir(directory):
+    """
+    compiled templates are saved in directory and reused by later processes
+
+    :param directory: cache directory, None for the default jinja2 cache directory, False to disable
+    :return:
+    """
+    global _bytecode_cache_dir
+    _bytecode_cache_dir = directory
+    with _lock:
+        _environments.clear()
+
+
+def get_environment(path):
+    """
+    :param path: template directory
+    :return: the jinja2 Environment shared by all templates in path
+    """
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _environments:
+            from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+            bytecode_cache = None
+            if _bytecode_cache_dir is not False:
+                if _bytecode_cache_dir and not os.path.isdir(_bytecode_cache_dir):
+                    os.makedirs(_bytecode_cache_dir)
+                bytecode_cache = FileSystemBytecodeCache(_bytecode_cache_dir or None)
+            _environments[path] = Environment(loader=FileSystemLoader(path),
+                                              bytecode_cache=bytecode_cache,
+                                              auto_reload=_debug)
+        return _environments[path]
+
+
+def get_template(template_file):
+    """
+    :param template_file: path of a jinja2 template file
+    :return: compiled template, parsed only once per process
+    """
+    path, name = os.path.split(template_file)
+    return get_environment(path or '.').get_template(name)
+
+
+def get_package_template(name):
+    """
+    :param name: template in sqlmail/templates, such as sql_table.html
+    :return: compiled template
+    """
+    return get_environment(PACKAGE_TEMPLATE_DIR).get_template(name)
@@ -0,0 +1,388 @@
+#!/usr/bin/python
+# coding:utf-8
+__author__ = 'kevinftd'
+
+import logging
+import sys
+import threading
+import Queue
+from collections import OrderedDict
+
+
+def map_in_threads(func, items, max_workers=4):
+    """
+    call func for each item by at most max_workers threads
+
+    :param func: function with one argument
+    :param items: arguments of func
+    :param max_workers: max number of threads
+    :return: list of (result, exc_info) in the order of items,
+             exc_info is None if func returned normally, otherwise result is None
+    """
+    items = list(items)
+    results = [None] * len(items)
+    tasks = Queue.Queue()
+    for index, item in enumerate(items):
+        tasks.put((index, item))
+
+    def worker():
+        while True:
+            try:
+                index, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = (func(item), None)
+            except Exception:
+                results[index] = (None, sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(max_workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+class TaskGraphException(Exception):
+    """Exception when tasks cannot be run, such as a dependency cycle or a failed dependency """
+
+
+class _Task(object):
+    def __init__(self, name, func, deps, resource):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.resource = resource
+
+
+class TaskGraph(object):
+    """
+    tasks with dependencies, each task starts as soon as all its dependencies are done
+
+    At most max_workers tasks run at the same time,
+    and at most limits[resource] tasks of the same resource, such as a db host.
+    A task whose dependency failed is not run.
+    """
+    def __init__(self, max_workers=4, limits=None, default_limit=None):
+        """
+        :param max_workers: max number of tasks running at the same time
+        :param limits: dict of resource -> max number of its tasks running at the same time
+        :param default_limit: limit of resources not in limits, None for no limit.
+                              Tasks without resource are only limited by max_workers
+        :return:
+        """
+        self.max_workers = max(1, max_workers)
+        self.limits = limits or dict()
+        self.default_limit = default_limit
+        self.tasks = OrderedDict()
+
+    def add(self, name, func, deps=(), resource=None):
+        """
+        :param name: unique task name
+        :param func: function of a dict of dependency name -> result, returns the result of this task
+        :param deps: names of tasks to finish first
+        :param resource: such as a db host, to limit tasks running at the same time
+        :return:
+        """
+        if name in self.tasks:
+            raise TaskGraphException("Task %s is added twice" % (name,))
+        self.tasks[name] = _Task(name, func, deps, resource)
+
+    def _check(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise TaskGraphException("Task %s depends on unknown task %s" % (task.name, dep))
+        # topological sort, tasks left are in a cycle
+        waiting = dict((task.name, set(task.deps)) for task in self.tasks.values())
+        while waiting:
+            ready = [name for name, deps in waiting.items() if not deps]
+            if not ready:
+                raise TaskGraphException("Tasks depend on each other: %s" % (", ".join(sorted(waiting)),))
+            for name in ready:
+                del waiting[name]
+            for deps in waiting.values():
+                deps.difference_update(ready)
+
+    def _limit(self, resource):
+        if resource is None:
+            return None
+        return self.limits.get(resource, self.default_limit)
+
+    def run(self):
+        """
+        :return: OrderedDict in the order tasks are added, name -> (result, exc_info),
+                 exc_info is None if the task succeeded
+        """
+        self._check()
+        results = dict()
+        started = set()
+        resource_running = dict()
+        condition = threading.Condition()
+        state = {"running": 0}
+
+        def execute(task, dep_results):
+            try:
+                result = (task.func(dep_results), None)
+            except Exception:
+                result = (None, sys.exc_info())
+            with condition:
+                results[task.name] = result
+                state["running"] -= 1
+                resource_running[task.resource] -= 1
+                condition.notify()
+
+        with condition:
+            while len(results) < len(self.tasks):
+                progress = True
+                while progress:
+                    progress = False
+                    for task in self.tasks.values():
+                        if task.name in started:
+                            continue
+                        failed = [dep for dep in task.deps if dep in results and results[dep][1] is not None]
+                        if failed:
+                            try:
+                                raise TaskGraphException("Task %s is not run since %s failed" % (task.name,
+                                                                                              failed[0]))
+                            except TaskGraphException:
+                                results[task.name] = (None, sys.exc_info())
+                            started.add(task.name)
+                            progress = True
+                            continue
+                        if any([dep not in results for dep in task.deps]):
+                            continue
+                        if state["running"] >= self.max_workers:
+                            break
+                        limit = self._limit(task.resource)
+                        if limit is not None and resource_running.get(task.resource, 0) >= limit:
+                            continue
+
+                        started.add(task.name)
+                        state["running"] += 1
+                        resource_running[task.resource] = resource_running.get(task.resource, 0) + 1
+                        thread = threading.Thread(target=execute,
+                                                  args=(task, dict((dep, results[dep][0]) for dep in task.deps)))
+                        thread.daemon = True
+                        thread.start()
+                        progress = True
+                if len(results) < len(self.tasks):
+                    if state["running"] == 0:
+                        raise TaskGraphException("No task can be started, a resource limit may be 0")
+                    condition.wait()
+
+        return OrderedDict((name, results[name]) for name in self.tasks)
+
+
+class FutureTimeoutException(Exception):
+    """Exception when the result of a future is not ready in time """
+
+
+class FutureException(Exception):
+    """Exception when a future is set twice or a function is submitted to a shut down executor """
+
+
+class Future(object):
+    """
+    result of a function running in another thread, such as a query submitted to an Executor
+
+    Callbacks added by add_done_callback are called with the future when it is done,
+    in the thread that finished it, or at once if it is already done.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = list()
+
+    def done(self):
+        return self._done
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exc_info(self, exc_info):
+        self._finish(None, exc_info)
+
+    def _finish(self, result, exc_info):
+        with self._condition:
+            if self._done:
+                raise FutureException("Future is already done")
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = list()
+            self._condition.notify_all()
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            logging.exception("future callback failed")
+
+    def add_done_callback(self, callback):
+        """
+        :param callback: function of this future
+        :return:
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise FutureTimeoutException("Future is not done after %s seconds" % (timeout,))
+
+    def exc_info(self, timeout=None):
+        """
+        :param timeout: seconds to wait, None to wait forever
+        :return: exc_info of the exception raised, None if the function returned normally
+        """
+        self._wait(timeout)
+        return self._exc_info
+
+    def result(self, timeout=None):
+        """
+        :param timeout: seconds to wait, None to wait forever
+        :return: the result, or raise the exception raised by the function
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def then(self, func, on_error=None):
+        """
+        :param func: function of the result of this future
+        :param on_error: function of the exception if this future fails, such as to raise another exception
+        :return: Future of func(result), or of on_error(exception) if this future fails,
+                 it fails if this future fails and on_error is None
+        """
+        future = Future()
+
+        def chain(done):
+            if done._exc_info and on_error is None:
+                future.set_exc_info(done._exc_info)
+                return
+            try:
+                result = on_error(done._exc_info[1]) if done._exc_info else func(done._result)
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+                return
+            future.set_result(result)
+        self.add_done_callback(chain)
+        return future
+
+
+def completed_future(result):
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def gather(futures):
+    """
+    :param futures: list of Future
+    :return: Future of the list of their results, it fails as soon as one of them fails
+    """
+    futures = list(futures)
+    gathered = Future()
+    if not futures:
+        gathered.set_result(list())
+        return gathered
+
+    lock = threading.Lock()
+    state = {"left": len(futures), "failed": False}
+
+    def collect(done):
+        with lock:
+            if state["failed"]:
+                return
+            if done._exc_info:
+                state["failed"] = True
+            else:
+                state["left"] -= 1
+                if state["left"] > 0:
+                    return
+        if done._exc_info:
+            gathered.set_exc_info(done._exc_info)
+        else:
+            gathered.set_result([f._result for f in futures])
+    for future in futures:
+        future.add_done_callback(collect)
+    return gathered
+
+
+class Executor(object):
+    """
+    a fixed number of worker threads running submitted functions,
+    so hundreds of queries can be submitted without starting hundreds of threads
+    """
+    def __init__(self, max_workers=16):
+        self.max_workers = max(1, max_workers)
+        self.tasks = Queue.Queue()
+        self.threads = list()
+        self.idle = 0
+        self.lock = threading.Lock()
+        self.is_shutdown = False
+
+    def submit(self, func, *args, **kwargs):
+        """
+        :return: Future of func(*args, **kwargs)
+        """
+        future = Future()
+        with self.lock:
+            if self.is_shutdown:
+                raise FutureException("Executor is shut down")
+            # workers are started when needed
+            if self.idle <= self.tasks.qsize() and len(self.threads) < self.max_workers:
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+            self.tasks.put((future, func, args, kwargs))
+        return future
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            task = self.tasks.get()
+            with self.lock:
+                self.idle -= 1
+            if task is None:
+                return
+            future, func, args, kwargs = task
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future.set_exc_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def shutdown(self, wait=True):
+        """
+        stop the workers after the submitted functions are done
+
+        :param wait: wait for the workers to stop
+        :return:
+        """
+        with self.lock:
+            self.is_shutdown = True
+            for _ in self.threads:
+                self.tasks.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()